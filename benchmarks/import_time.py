@@ -0,0 +1,58 @@
+"""
+Measures how long it takes a fresh interpreter to import sisyphus_control,
+compared with importing its network dependencies directly.
+
+    python benchmarks/import_time.py [--runs N]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+STATEMENTS = [
+    "import sisyphus_control",
+    "from sisyphus_control import Table",
+    "import aiohttp, socketio_v4",
+]
+
+
+def measure(statement: str, runs: int) -> float:
+    """Median cumulative import time of statement, in milliseconds, as
+reported by -X importtime for the top-level modules it imports."""
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=repo_root)
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", statement],
+            env=env,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True)
+        total_us = 0
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            # Only count top-level entries; nested ones are included in them
+            if not cumulative.strip().isdigit() or name.startswith("  "):
+                continue
+            total_us += int(cumulative)
+        samples.append(total_us / 1000)
+    return statistics.median(samples)
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--runs", type=int, default=10)
+    args = arg_parser.parse_args()
+
+    for statement in STATEMENTS:
+        print("{time:8.1f} ms  {statement}".format(
+            time=measure(statement, args.runs), statement=statement))
+
+
+if __name__ == "__main__":
+    main()
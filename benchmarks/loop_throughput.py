@@ -0,0 +1,74 @@
+"""
+Measures how many table commands per second one event loop can drive, with
+asyncio's default loop and with uvloop (if installed). Tables are connected to
+in-process simulated tables through LoopbackTransport, so the numbers reflect
+this library's and the loop's overhead rather than the network's.
+
+    python benchmarks/loop_throughput.py [--tables N] [--commands N] [--runs N]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sisyphus_control import Table, eventloop  # noqa: E402
+from sisyphus_control.loopback import SimulatedSisbot  # noqa: E402
+
+
+async def drive(num_tables: int, num_commands: int) -> float:
+    """Commands per second for num_tables tables each sending num_commands
+set_speed and set_brightness commands concurrently"""
+    tables = []
+    for index in range(num_tables):
+        sisbot = SimulatedSisbot(name="Table {index}".format(index=index))
+        tables.append(await Table.connect(
+            "sim-{index}".format(index=index),
+            transport_factory=sisbot.transport_factory()))
+
+    async def run_commands(table: Table) -> None:
+        for i in range(num_commands):
+            if i % 2:
+                await table.set_speed((i % 10) / 10)
+            else:
+                await table.set_brightness((i % 10) / 10)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run_commands(table) for table in tables])
+    elapsed = time.perf_counter() - start
+
+    await asyncio.gather(*[table.close() for table in tables])
+    return num_tables * num_commands / elapsed
+
+
+def measure(use_uvloop: bool, num_tables: int, num_commands: int, runs: int) -> float:
+    """Median commands per second over runs, each on a fresh loop"""
+    return statistics.median(
+        eventloop.run(drive(num_tables, num_commands), use_uvloop)
+        for _ in range(runs))
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--tables", type=int, default=200)
+    arg_parser.add_argument("--commands", type=int, default=50)
+    arg_parser.add_argument("--runs", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    loops = [("asyncio", False)]
+    if eventloop.uvloop_available():
+        loops.append(("uvloop", True))
+    else:
+        print("uvloop is not installed; install the uvloop extra to compare")
+
+    for name, use_uvloop in loops:
+        rate = measure(use_uvloop, args.tables, args.commands, args.runs)
+        print("{rate:10.0f} commands/s  {name}".format(rate=rate, name=name))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,14 @@ import asyncio
 import aiohttp
 import cmd
 import io
+import json
 import logging
 import shlex
 import sys
-import threading
+import time
 
-from sisyphus_control import Table
+from sisyphus_control import Table, eventloop
+from sisyphus_control.sync import LoopThread
 
 
 class SisyphusShell(cmd.Cmd):
@@ -16,9 +18,9 @@ class SisyphusShell(cmd.Cmd):
     prompt = "(sisyphus) "
     file = None
 
-    def __init__(self, loop):
+    def __init__(self, loop_thread):
         super().__init__()
-        self._loop = loop
+        self._loop_thread = loop_thread
         self._table = None
         self._running_cmd = False
 
@@ -187,7 +189,7 @@ class SisyphusShell(cmd.Cmd):
                 print_playlist(playlist)
 
     def _async_do(self, coro):
-        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+        return self._loop_thread.run(coro)
 
     def _expect_connected(self):
         if self._table is None:
@@ -296,15 +298,186 @@ def print_table(table):
     )
 
 
+BATCH_COMMANDS = {
+    "play": (0, 2),
+    "pause": (0, 0),
+    "sleep": (0, 0),
+    "wakeup": (0, 0),
+    "refresh": (0, 0),
+    "set_speed": (1, 1),
+    "set_brightness": (1, 1),
+    "set_shuffle": (1, 1),
+    "set_loop": (1, 1),
+    "wait": (1, 1),
+}
+
+
+def parse_fraction(value):
+    number = float(value)
+    if not 0 <= number <= 1:
+        raise ValueError("{value} is not between 0 and 1".format(value=value))
+    return number
+
+
+def parse_switch(value):
+    if value.lower() in ("1", "true", "on", "yes"):
+        return True
+    if value.lower() in ("0", "false", "off", "no"):
+        return False
+    raise ValueError("{value} is not on or off".format(value=value))
+
+
+def parse_non_negative(convert):
+    def parse(value):
+        number = convert(value)
+        if number < 0:
+            raise ValueError("{value} is negative".format(value=value))
+        return number
+    return parse
+
+
+# Converters for each command's arguments, by position; arguments without
+# one are kept as strings
+BATCH_ARGUMENT_TYPES = {
+    "play": [str, parse_non_negative(int)],
+    "set_speed": [parse_fraction],
+    "set_brightness": [parse_fraction],
+    "set_shuffle": [parse_switch],
+    "set_loop": [parse_switch],
+    "wait": [parse_non_negative(float)],
+}
+
+
+def parse_batch_script(lines):
+    """Parses one command per line into (line, args) pairs, converting and
+    checking the arguments so that a bad script fails before any table is
+    contacted. Blank lines and lines starting with # are skipped; "set speed
+    0.5" is accepted as well as "set_speed 0.5"."""
+    commands = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        args = shlex.split(line)
+        if args[0] == "set" and len(args) >= 2:
+            args = ["set_" + args[1]] + args[2:]
+        arg_range = BATCH_COMMANDS.get(args[0])
+        if arg_range is None:
+            raise ValueError("line {line_number}: unknown command {command}".format(
+                line_number=line_number, command=args[0]))
+        min_args, max_args = arg_range
+        if not min_args <= len(args) - 1 <= max_args:
+            raise ValueError("line {line_number}: wrong number of arguments for {command}".format(
+                line_number=line_number, command=args[0]))
+        converters = BATCH_ARGUMENT_TYPES.get(args[0], [])
+        for index, (arg, convert) in enumerate(zip(args[1:], converters), 1):
+            try:
+                args[index] = convert(arg)
+            except ValueError as e:
+                raise ValueError("line {line_number}: bad argument for {command}: {error}".format(
+                    line_number=line_number, command=args[0], error=e))
+        commands.append((line, args))
+    return commands
+
+
+async def run_batch_command(table, args):
+    command = args[0]
+    if command == "play":
+        if len(args) == 1:
+            await table.play()
+            return
+        playlist = table.get_playlist_by_id(args[1])
+        if playlist is None:
+            track = table.get_track_by_id(args[1])
+            if track is None:
+                raise ValueError("No playlist or track with id {id}".format(id=args[1]))
+            await track.play()
+            return
+        track = playlist.tracks[args[2]] if len(args) > 2 else None
+        await playlist.play(track)
+    elif command == "wait":
+        await asyncio.sleep(args[1])
+    elif command in ("set_speed", "set_brightness", "set_shuffle", "set_loop"):
+        await getattr(table, command)(args[1])
+    else:
+        await getattr(table, command)()
+
+
+async def run_batch_on_table(ip, commands, session, out):
+    def emit(result):
+        result["ip"] = ip
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+
+    start = time.monotonic()
+    try:
+        table = await Table.connect(ip, session)
+    except Exception as e:
+        emit({"command": "connect", "ok": False, "error": str(e),
+              "elapsed_ms": round((time.monotonic() - start) * 1000, 1)})
+        return False
+
+    ok = True
+    async with table:
+        for line, args in commands:
+            command_start = time.monotonic()
+            error = None
+            try:
+                await run_batch_command(table, args)
+            except Exception as e:
+                error = str(e)
+                ok = False
+            emit({"table": table.name, "command": line, "ok": error is None,
+                  "error": error,
+                  "elapsed_ms": round((time.monotonic() - command_start) * 1000, 1)})
+            if error is not None:
+                break
+
+    emit({"table": table.name, "command": None, "ok": ok, "error": None,
+          "elapsed_ms": round((time.monotonic() - start) * 1000, 1)})
+    return ok
+
+
+async def run_batch(ips, commands, out=sys.stdout):
+    """Runs the commands in order on each table, all tables at once, writing
+    one JSON object per line for each command and a final one per table.
+    Returns whether everything succeeded."""
+    async with aiohttp.ClientSession() as session:
+        if ips is None:
+            ips = await Table.find_table_ips(session)
+        results = await asyncio.gather(
+            *[run_batch_on_table(ip, commands, session, out) for ip in ips])
+    return all(results)
+
+
 if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
-    loop.set_debug(True)
-    loop_thread = threading.Thread(target=loop.run_forever)
-    loop_thread.start()
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "--batch", metavar="SCRIPT",
+        help="run the commands in SCRIPT (- for stdin) instead of the interactive shell")
+    arg_parser.add_argument(
+        "--ip", action="append", dest="ips", metavar="IP",
+        help="table to run the batch on; may be given more than once")
+    arg_parser.add_argument(
+        "--discover", action="store_true",
+        help="run the batch on every table found on the local network")
+    args = arg_parser.parse_args()
 
-    cmd = SisyphusShell(loop)
+    if args.batch is not None:
+        if not args.ips and not args.discover:
+            arg_parser.error("--batch requires --ip or --discover")
+        script = sys.stdin if args.batch == "-" else open(args.batch)
+        with script:
+            try:
+                commands = parse_batch_script(script)
+            except ValueError as e:
+                arg_parser.error(str(e))
+        ips = None if args.discover else args.ips
+        sys.exit(0 if eventloop.run(run_batch(ips, commands)) else 1)
+
+    loop_thread = LoopThread(debug=True)
+
+    cmd = SisyphusShell(loop_thread)
     cmd.cmdloop()
 
-    loop.call_soon_threadsafe(loop.stop)
-    loop_thread.join()
-    loop.close()
+    loop_thread.stop()
@@ -3,8 +3,37 @@ Classes for inspecting and controlling your Sisyphus Kinetic Art Table.
 <https://www.sisyphus-industries.com>
 """
 
-from .table import Table
-from .playlist import Playlist
-from .track import Track
+from typing import TYPE_CHECKING, Any, List
+
+if TYPE_CHECKING:
+    from .table import Table
+    from .playlist import Playlist
+    from .track import Track
 
 __all__ = ["Table", "Playlist", "Track"]
+
+# Submodules are imported on first use so that importing the package stays
+# cheap for short-lived scripts
+_LAZY_EXPORTS = {
+    "Table": ".table",
+    "Playlist": ".playlist",
+    "Track": ".track",
+}
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _LAZY_EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(
+            "module {module!r} has no attribute {name!r}".format(
+                module=__name__, name=name))
+
+    import importlib
+
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(list(globals().keys()) + __all__)
@@ -0,0 +1,237 @@
+r"""
+Recording of table traffic, and replay of recordings into a Table for load
+testing and profiling the state-handling and listener code offline.
+
+Pass a TrafficRecorder to TableTransport (or Table.connect) to record every
+request it posts and every socket.io event it receives. Recordings are JSON
+lines, one entry per request or event::
+
+    {"t": 1.234, "kind": "http", "endpoint": "state", "request": {...},
+     "response": [...], "error": null, "duration": 0.05}
+    {"t": 1.5, "kind": "socket", "event": "set", "data": [...]}
+
+where ``t`` is seconds since the recording started.
+"""
+
+from typing import IO, Any, Dict, Iterable, List, Optional
+
+import asyncio
+import cProfile
+import json
+import pstats
+import time
+import tracemalloc
+
+from . import table as table_module
+
+RecordingEntry = Dict[str, Any]
+
+
+class TrafficRecorder:
+    """Keeps entries in memory, or streams them to path if one is given so
+that long captures don't grow memory."""
+
+    def __init__(self, path: Optional[str] = None):
+        self._start = time.monotonic()
+        self._entries: List[RecordingEntry] = []
+        self._file: Optional[IO[str]] = open(path, "a") if path else None
+
+    @property
+    def entries(self) -> List[RecordingEntry]:
+        """Recorded entries; empty when recording to a file"""
+        return self._entries
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            for entry in self._entries:
+                f.write(json.dumps(entry) + "\n")
+
+    def record_http(
+            self,
+            endpoint: str,
+            request: Optional[Dict[str, Any]],
+            response: Any,
+            error: Optional[BaseException],
+            duration: float) -> None:
+        self._record({
+            "kind": "http",
+            "endpoint": endpoint,
+            "request": request,
+            "response": response,
+            "error": str(error) if error is not None else None,
+            "duration": duration,
+        })
+
+    def record_socket(self, event: str, data: Any) -> None:
+        self._record({"kind": "socket", "event": event, "data": data})
+
+    def _record(self, entry: RecordingEntry) -> None:
+        entry["t"] = time.monotonic() - self._start
+        if self._file is not None:
+            self._file.write(json.dumps(entry) + "\n")
+        else:
+            self._entries.append(entry)
+
+
+def load_recording(path: str) -> List[RecordingEntry]:
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayResult:
+    def __init__(
+            self,
+            updates: int,
+            elapsed: float,
+            profile: Optional[pstats.Stats],
+            memory: Optional[tracemalloc.Snapshot]):
+        self.updates = updates
+        self.elapsed = elapsed
+        self.profile = profile
+        self.memory = memory
+
+    def __str__(self) -> str:
+        return "{updates} updates in {elapsed:.3f}s ({rate:.0f}/s)".format(
+            updates=self.updates,
+            elapsed=self.elapsed,
+            rate=self.updates / self.elapsed if self.elapsed else 0)
+
+
+async def replay(
+        recording: Iterable[RecordingEntry],
+        table: Optional["table_module.Table"] = None,
+        speed: Optional[float] = 1.0,
+        profile: bool = False,
+        trace_memory: bool = False) -> ReplayResult:
+    """Feed the table's side of a recording to table's state handling (a new
+unconnected Table if None) as if it were arriving from a real table. speed is
+a multiple of the recorded pace; None replays as fast as possible. With
+profile, the result includes cProfile stats for the replay; with
+trace_memory, a tracemalloc snapshot taken at the end.
+
+Geometry downloads for prefetch and duration calibration are suspended during
+the replay, since they would skew the measurement."""
+    if table is None:
+        table = table_module.Table()
+    downloads = (table._prefetch_count, table._calibration_downloads)
+    table._prefetch_count = 0
+    table._calibration_downloads = False
+
+    profiler = cProfile.Profile() if profile else None
+    if trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+
+    updates = 0
+    start = time.monotonic()
+    first_t: Optional[float] = None
+    try:
+        for entry in recording:
+            if entry["kind"] == "http":
+                if entry.get("error") is not None:
+                    continue
+                payload = entry.get("response")
+            elif entry["kind"] == "socket" and entry["event"] == "set":
+                payload = entry.get("data")
+            elif entry["kind"] == "socket" and entry["event"] == "disconnect":
+                payload = None
+            else:
+                continue
+
+            if speed is not None:
+                if first_t is None:
+                    first_t = entry["t"]
+                delay = (entry["t"] - first_t) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            await table._try_update_table_state(payload)
+            updates += 1
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        table._prefetch_count, table._calibration_downloads = downloads
+        memory = None
+        if trace_memory:
+            memory = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    return ReplayResult(
+        updates,
+        time.monotonic() - start,
+        pstats.Stats(profiler) if profiler is not None else None,
+        memory)
+
+
+if __name__ == "__main__":
+    import aiounittest
+    import unittest
+
+    from .loopback import SimulatedSisbot
+
+    SISBOT = {
+        "id": "sisbot",
+        "type": "sisbot",
+        "name": "Recorded",
+        "state": "playing",
+        "speed": 0.5,
+        "brightness": 0.5,
+        "playlist_ids": [],
+        "track_ids": ["t1"],
+        "active_playlist_id": "false",
+        "active_track": {"id": "t1", "name": "One"},
+    }
+
+    RECORDING: List[RecordingEntry] = [
+        {"t": 0.0, "kind": "http", "endpoint": "connect", "request": None,
+         "response": [SISBOT, {"id": "t1", "type": "track", "name": "One"}],
+         "error": None, "duration": 0.01},
+        {"t": 0.1, "kind": "http", "endpoint": "get_track_time", "request": None,
+         "response": [{"remaining_time": 60000, "total_time": 90000}],
+         "error": None, "duration": 0.01},
+        {"t": 0.2, "kind": "socket", "event": "set",
+         "data": [dict(SISBOT, speed=0.8)]},
+        {"t": 0.3, "kind": "http", "endpoint": "set_speed", "request": None,
+         "response": None, "error": "timed out", "duration": 5},
+    ]
+
+    class ReplayTests(aiounittest.AsyncTestCase):
+        async def test_replay_into_unconnected_table(self) -> None:
+            table = table_module.Table()
+            result = await replay(RECORDING, table, speed=None, profile=True)
+
+            self.assertEqual(result.updates, 3)
+            self.assertIsNotNone(result.profile)
+            self.assertEqual(table.speed, 0.8)
+            self.assertEqual(table.active_track_total_time.total_seconds(), 90)
+
+        async def test_replay_does_not_download(self) -> None:
+            sisbot = SimulatedSisbot()
+            sisbot.add_track("t1", "One", "0 0\n1 1\n")
+            table = await table_module.Table.connect(
+                "loopback", transport_factory=sisbot.transport_factory())
+            table.enable_calibration()
+            table.enable_prefetch()
+            requests: List[str] = []
+            handle = sisbot.handle
+
+            async def recording_handle(endpoint: str, data: Any) -> Any:
+                requests.append(endpoint)
+                return await handle(endpoint, data)
+
+            sisbot.handle = recording_handle  # type: ignore
+            await replay(RECORDING, table, speed=None)
+
+            self.assertEqual(requests, [])
+            self.assertEqual(len(table._background_tasks), 0)
+            self.assertTrue(table._calibration_downloads)
+            self.assertEqual(table._prefetch_count, 2)
+            await table.close()
+
+    unittest.main()
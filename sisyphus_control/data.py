@@ -1,10 +1,13 @@
 import asyncio
 from collections import UserDict
-from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Union
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Iterable, Union
 
-from .util import ensure_coroutine
+from .listeners import ListenerRegistry, Subscription
 
 CollectionListener = Union[Callable[[], None], Callable[[], Awaitable[None]]]
+ChangeListener = Union[
+    Callable[[Union[str, int], Dict[str, Any]], None],
+    Callable[[Union[str, int], Dict[str, Any]], Awaitable[None]]]
 
 
 class Model(UserDict):
@@ -13,16 +16,49 @@ class Model(UserDict):
     def __init__(self, data: Dict[str, Any]):
         super().__init__(data)
 
-    async def update_from_changes(self, changes: 'Model') -> bool:
-        data_changed = False
+    async def update_from_changes(self, changes: 'Model') -> Dict[str, Any]:
+        """Returns the keys that changed, with their new values (so the result
+is falsy if nothing changed)"""
+        changed: Dict[str, Any] = {}
         for key, value in changes.items():
             if not key in self or self[key] != value:
                 self[key] = value
-                data_changed = True
+                changed[key] = value
+
+        return changed
+
+    def apply_optimistic(self, changes: Dict[str, Any]) -> Dict[str, Any]:
+        """Apply changes that are expected to be confirmed by the table.
+Returns the previous values of the keys that actually changed, to be passed
+to rollback if the change is rejected."""
+        previous: Dict[str, Any] = {}
+        for key, value in changes.items():
+            old_value = self.get(key, _MISSING)
+            if old_value != value:
+                previous[key] = old_value
+                self[key] = value
+
+        return previous
+
+    def rollback(self, changes: Dict[str, Any], previous: Dict[str, Any]) -> bool:
+        """Undo apply_optimistic. Keys that have been updated by the table in
+the meantime are left alone. Returns whether anything was changed."""
+        data_changed = False
+        for key, old_value in previous.items():
+            if self.get(key, _MISSING) != changes[key]:
+                continue
+            if old_value is _MISSING:
+                del self[key]
+            else:
+                self[key] = old_value
+            data_changed = True
 
         return data_changed
 
 
+_MISSING = object()
+
+
 if TYPE_CHECKING:
     CollectionBase = UserDict[Union[str, int], Model]
 else:
@@ -34,29 +70,67 @@ class Collection(CollectionBase):
 
     def __init__(self):
         super().__init__()
-        self._listeners: List[CollectionListener] = []
+        self._listeners: ListenerRegistry = ListenerRegistry()
+        self._change_listeners: ListenerRegistry = ListenerRegistry()
 
     async def add(self, item: Model) -> None:
         id = item.data["id"]
         if id in self:
-            should_notify = await self[id].update_from_changes(item)
+            changed = await self[id].update_from_changes(item)
         else:
             self[id] = item
-            should_notify = True
+            changed = dict(item)
 
-        if should_notify:
+        if changed:
+            await self._change_listeners.notify(id, changed)
             await self._notify_listeners()
 
-    def add_listener(self, listener: CollectionListener) -> None:
-        self._listeners.append(listener)
+    async def report_changes(self, model: Model, keys: Iterable[str]) -> None:
+        """Tell change listeners about keys of model that were changed
+directly rather than through add (the values reported are the current ones;
+keys that were removed are reported as None). Doesn't notify listeners."""
+        if "id" in model and model["id"] in self:
+            await self._change_listeners.notify(
+                model["id"], {key: model.get(key) for key in keys})
+
+    def add_listener(self, listener: CollectionListener, weak: bool = False) -> Subscription:
+        return self._listeners.add(listener, weak)
+
+    def add_change_listener(self, listener: ChangeListener, weak: bool = False) -> Subscription:
+        """listener is called with the ID of a model and the keys that changed
+(with their new values) before the collection's listeners are notified"""
+        return self._change_listeners.add(listener, weak)
+
+    def remove_change_listener(self, listener: ChangeListener) -> None:
+        self._change_listeners.remove(listener)
 
     def remove_listener(self, listener: CollectionListener) -> None:
         self._listeners.remove(listener)
 
     async def _notify_listeners(self) -> None:
-        listeners = list(self._listeners)
-        for listener in listeners:
-            await ensure_coroutine(listener)()  # type: ignore
+        await self._listeners.notify()
+
+
+Snapshot = Dict[str, Dict[str, Any]]
+
+
+def snapshot_collection(collection: Collection) -> Snapshot:
+    """Copies of every model in the collection, keyed by string ID. Copies are
+shallow: values are replaced, not mutated, when the table reports changes."""
+    return {str(model_id): dict(model) for model_id, model in collection.items()}
+
+
+def diff_snapshots(old: Snapshot, new: Snapshot) -> Snapshot:
+    """Keys that are new or changed in new, by model ID"""
+    changes: Snapshot = {}
+    for model_id, model in new.items():
+        old_model = old.get(model_id, {})
+        changed = {
+            key: value for key, value in model.items()
+            if key not in old_model or old_model[key] != value}
+        if changed:
+            changes[model_id] = changed
+    return changes
 
 
 if __name__ == "__main__":
@@ -130,4 +204,62 @@ if __name__ == "__main__":
 
             assert not listener.called
 
+        async def test_weak_listener_is_dropped(self) -> None:
+            class Subscriber:
+                called = False
+
+                def on_change(self) -> None:
+                    self.called = True
+
+            coll = Collection()
+            subscriber = Subscriber()
+            coll.add_listener(subscriber.on_change, weak=True)
+            await coll.add(Model({"id": 12345}))
+            assert subscriber.called
+
+            del subscriber
+            self.assertEqual(len(coll._listeners), 0)
+
+        async def test_removed_subscription_does_not_notify(self) -> None:
+            coll = Collection()
+            listener = MagicMock()
+            with coll.add_listener(listener):
+                await coll.add(Model({"id": 12345}))
+            await coll.add(Model({"id": 67890}))
+
+            self.assertEqual(listener.call_count, 1)
+
+        async def test_change_listeners_get_changed_keys(self) -> None:
+            coll = Collection()
+            changes = []
+            coll.add_change_listener(lambda id, changed: changes.append((id, changed)))
+            await coll.add(Model({"id": 12345, "key": "value", "other": 1}))
+            await coll.add(Model({"id": 12345, "key": "new_value", "other": 1}))
+            await coll.add(Model({"id": 12345, "key": "new_value"}))
+
+            self.assertEqual(changes, [
+                (12345, {"id": 12345, "key": "value", "other": 1}),
+                (12345, {"key": "new_value"}),
+            ])
+
+    class ModelTests(unittest.TestCase):
+        def test_rollback_restores_previous_values(self) -> None:
+            model = Model({"id": 12345, "key": "value"})
+            changes = {"key": "new_value", "key2": "value2"}
+            previous = model.apply_optimistic(changes)
+            self.assertEqual(model, Model(
+                {"id": 12345, "key": "new_value", "key2": "value2"}))
+
+            self.assertTrue(model.rollback(changes, previous))
+            self.assertEqual(model, Model({"id": 12345, "key": "value"}))
+
+        def test_rollback_keeps_values_updated_by_table(self) -> None:
+            model = Model({"id": 12345, "key": "value"})
+            changes = {"key": "new_value"}
+            previous = model.apply_optimistic(changes)
+            model["key"] = "table_value"
+
+            self.assertFalse(model.rollback(changes, previous))
+            self.assertEqual(model["key"], "table_value")
+
     unittest.main()
@@ -0,0 +1,157 @@
+from datetime import timedelta
+from typing import Dict, Optional, Tuple
+
+# Speed 0 still moves the ball, so never divide by less than this
+MIN_SPEED_FACTOR = 0.1
+
+DEFAULT_SECONDS_PER_UNIT = 2.0
+
+
+class DurationModel:
+    """Estimates how long a track takes to play from its path length and the
+table speed:
+
+    seconds = seconds_per_unit * path_length / speed_factor(speed) + overhead
+
+The coefficients start from a rough default and are fitted by least squares
+to observed track times as they are reported by the table."""
+
+    def __init__(
+            self,
+            seconds_per_unit: float = DEFAULT_SECONDS_PER_UNIT,
+            overhead: float = 0.0):
+        self._seconds_per_unit = seconds_per_unit
+        self._overhead = overhead
+        self._path_lengths: Dict[str, float] = {}
+        self._last_observation: Optional[Tuple[str, float]] = None
+        # Running sums for the least-squares fit
+        self._n = 0
+        self._sum_x = 0.0
+        self._sum_y = 0.0
+        self._sum_xx = 0.0
+        self._sum_xy = 0.0
+
+    @property
+    def seconds_per_unit(self) -> float:
+        return self._seconds_per_unit
+
+    @property
+    def overhead(self) -> float:
+        return self._overhead
+
+    @property
+    def sample_count(self) -> int:
+        return self._n
+
+    @staticmethod
+    def speed_factor(speed: float) -> float:
+        return MIN_SPEED_FACTOR + (1 - MIN_SPEED_FACTOR) * max(0.0, min(speed, 1.0))
+
+    def get_path_length(self, track_id: str) -> Optional[float]:
+        return self._path_lengths.get(track_id)
+
+    def set_path_length(self, track_id: str, path_length: float) -> None:
+        self._path_lengths[track_id] = path_length
+
+    def estimate(self, path_length: float, speed: float) -> timedelta:
+        seconds = (self._seconds_per_unit * path_length / self.speed_factor(speed)
+                   + self._overhead)
+        return timedelta(seconds=max(0.0, seconds))
+
+    def estimate_track(self, track_id: str, speed: float) -> Optional[timedelta]:
+        """Estimate for a track whose path length is cached, else None"""
+        path_length = self._path_lengths.get(track_id)
+        if path_length is None:
+            return None
+        return self.estimate(path_length, speed)
+
+    def observe_track(self, track_id: str, speed: float, total_time: timedelta) -> bool:
+        """Calibrate against a total time reported by the table. The table
+reports the same total repeatedly while a track plays; repeats are ignored.
+Returns whether the observation was used."""
+        path_length = self._path_lengths.get(track_id)
+        seconds = total_time.total_seconds()
+        if path_length is None or seconds <= 0:
+            return False
+        if self._last_observation == (track_id, seconds):
+            return False
+        self._last_observation = (track_id, seconds)
+
+        self.observe(path_length, speed, seconds)
+        return True
+
+    def observe(self, path_length: float, speed: float, seconds: float) -> None:
+        x = path_length / self.speed_factor(speed)
+        self._n += 1
+        self._sum_x += x
+        self._sum_y += seconds
+        self._sum_xx += x * x
+        self._sum_xy += x * seconds
+        self._fit()
+
+    def _fit(self) -> None:
+        variance = self._n * self._sum_xx - self._sum_x * self._sum_x
+        if self._n >= 2 and variance > 1e-9 * self._n * self._sum_xx:
+            slope = (self._n * self._sum_xy - self._sum_x * self._sum_y) / variance
+            intercept = (self._sum_y - slope * self._sum_x) / self._n
+            if slope > 0 and intercept >= 0:
+                self._seconds_per_unit = slope
+                self._overhead = intercept
+                return
+
+        # Too few distinct samples for two coefficients (or a nonsensical
+        # fit); fit a line through the origin instead
+        if self._sum_xx > 0:
+            self._seconds_per_unit = self._sum_xy / self._sum_xx
+            self._overhead = 0.0
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class DurationModelTests(unittest.TestCase):
+        def test_fits_rate_and_overhead(self) -> None:
+            model = DurationModel()
+            # 3 seconds per unit at full speed plus 10 seconds of homing
+            for track_id, path_length in [("a", 10.0), ("b", 40.0), ("c", 100.0)]:
+                model.set_path_length(track_id, path_length)
+                self.assertTrue(model.observe_track(
+                    track_id, 1.0, timedelta(seconds=3 * path_length + 10)))
+
+            self.assertEqual(model.sample_count, 3)
+            self.assertAlmostEqual(model.seconds_per_unit, 3.0)
+            self.assertAlmostEqual(model.overhead, 10.0)
+            self.assertAlmostEqual(
+                model.estimate(20.0, 1.0).total_seconds(), 70.0)
+
+        def test_speed_scales_estimate(self) -> None:
+            model = DurationModel(seconds_per_unit=2.0)
+            fast = model.estimate(10.0, 1.0)
+            slow = model.estimate(10.0, 0.0)
+            self.assertEqual(fast, timedelta(seconds=20))
+            self.assertAlmostEqual(slow / fast, 1 / MIN_SPEED_FACTOR)
+
+        def test_single_sample_fits_through_origin(self) -> None:
+            model = DurationModel()
+            model.set_path_length("a", 10.0)
+            model.observe_track("a", 1.0, timedelta(seconds=50))
+            self.assertAlmostEqual(model.seconds_per_unit, 5.0)
+            self.assertEqual(model.overhead, 0.0)
+
+        def test_repeated_and_unusable_reports_are_ignored(self) -> None:
+            model = DurationModel()
+            model.set_path_length("a", 10.0)
+            self.assertTrue(model.observe_track("a", 1.0, timedelta(seconds=50)))
+            self.assertFalse(model.observe_track("a", 1.0, timedelta(seconds=50)))
+            self.assertFalse(model.observe_track("b", 1.0, timedelta(seconds=50)))
+            self.assertFalse(model.observe_track("a", 1.0, timedelta()))
+            self.assertEqual(model.sample_count, 1)
+
+        def test_estimate_track_needs_path_length(self) -> None:
+            model = DurationModel()
+            self.assertIsNone(model.estimate_track("a", 0.5))
+            model.set_path_length("a", 10.0)
+            self.assertEqual(
+                model.estimate_track("a", 0.5), model.estimate(10.0, 0.5))
+
+    unittest.main()
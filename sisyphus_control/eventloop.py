@@ -0,0 +1,56 @@
+r"""
+Event loop selection. Nothing in sisyphus_control binds to a loop until it is
+first used from a running one, so tables work on any asyncio-compatible loop;
+these helpers make it easy to use uvloop (the ``uvloop`` extra) where it is
+installed, which handles many concurrent table connections with less CPU.
+"""
+
+from typing import Any, Coroutine, Optional, TypeVar
+
+import asyncio
+
+T = TypeVar("T")
+
+
+def uvloop_available() -> bool:
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def new_event_loop(use_uvloop: Optional[bool] = None) -> asyncio.AbstractEventLoop:
+    """A new event loop: uvloop's if use_uvloop is True (ImportError if it
+isn't installed), asyncio's if False, and uvloop's if installed otherwise"""
+    if use_uvloop is None:
+        use_uvloop = uvloop_available()
+    if use_uvloop:
+        import uvloop
+
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def run(coro: Coroutine[Any, Any, T], use_uvloop: Optional[bool] = None) -> T:
+    """Like asyncio.run, on a loop from new_event_loop(use_uvloop)"""
+    loop = new_event_loop(use_uvloop)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coro)
+    finally:
+        try:
+            _cancel_remaining_tasks(loop)
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+def _cancel_remaining_tasks(loop: asyncio.AbstractEventLoop) -> None:
+    tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
+    if not tasks:
+        return
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
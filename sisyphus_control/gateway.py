@@ -0,0 +1,328 @@
+r"""
+A local HTTP/WebSocket server that shares one connection per table between
+any number of clients.
+
+Routes, where ``{id}`` is the table's ID:
+
+``GET /tables``
+    The ID, name and IP of each table.
+``GET /tables/{id}/state``
+    The cached state of the table: every model the table has reported, keyed
+    by ID, plus the active track's times.
+``GET /tables/{id}/events``
+    WebSocket. Sends a ``snapshot`` message with the state, then a ``delta``
+    message with only the changed keys whenever the state changes. Each
+    message carries a version number that increases by one per delta. Each
+    client has its own bounded queue of messages, so a slow client never holds
+    up the table or other clients; one that falls more than max_backlog
+    messages behind is disconnected.
+``POST /tables/{id}/commands/{endpoint}``
+    Sends the JSON object body (if any) to the table's sisbot endpoint and
+    returns its response; other bodies are rejected with status 400. Identical
+    commands that arrive while one is in flight share its result rather than
+    being sent again.
+"""
+
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import asyncio
+import json
+import logging
+
+from aiohttp import WSMsgType, web
+
+from .data import Snapshot, snapshot_collection
+from .table import Table
+
+_LOGGER = logging.getLogger("sisyphus-control")
+
+
+class TableGateway:
+    def __init__(
+            self,
+            tables: List[Table],
+            host: str = "127.0.0.1",
+            port: int = 8080,
+            max_backlog: int = 100):
+        self._host = host
+        self._port = port
+        self._tables: Dict[str, _GatewayTable] = {
+            table.id: _GatewayTable(table, max_backlog) for table in tables}
+        self._runner: Optional[web.AppRunner] = None
+
+        self._app = web.Application()
+        self._app.add_routes([
+            web.get("/tables", self._get_tables),
+            web.get("/tables/{id}/state", self._get_state),
+            web.get("/tables/{id}/events", self._get_events),
+            web.post("/tables/{id}/commands/{endpoint}", self._post_command),
+        ])
+
+    async def __aenter__(self) -> "TableGateway":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args: Any) -> bool:
+        await self.stop()
+        return False
+
+    @property
+    def app(self) -> web.Application:
+        return self._app
+
+    async def start(self) -> None:
+        for table in self._tables.values():
+            table.start()
+        self._runner = web.AppRunner(self._app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        _LOGGER.info(
+            "Gateway for %d tables listening on %s:%d",
+            len(self._tables),
+            self._host,
+            self._port)
+
+    async def stop(self) -> None:
+        for table in self._tables.values():
+            await table.stop()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _get_tables(self, request: web.Request) -> web.Response:
+        return web.json_response([
+            {
+                "id": table_id,
+                "name": gateway_table.table.name,
+                "ip": gateway_table.table._get_transport().ip,
+            }
+            for table_id, gateway_table in self._tables.items()])
+
+    async def _get_state(self, request: web.Request) -> web.Response:
+        gateway_table = self._get_gateway_table(request)
+        return web.json_response(gateway_table.snapshot_message())
+
+    async def _get_events(self, request: web.Request) -> web.WebSocketResponse:
+        gateway_table = self._get_gateway_table(request)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        subscriber = gateway_table.subscribe(ws)
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.ERROR:
+                    break
+        finally:
+            await gateway_table.unsubscribe(subscriber)
+        return ws
+
+    async def _post_command(self, request: web.Request) -> web.Response:
+        gateway_table = self._get_gateway_table(request)
+        data: Optional[Dict[str, Any]] = None
+        if request.can_read_body:
+            try:
+                data = await request.json()
+            except ValueError:
+                return web.json_response(
+                    {"err": "Request body is not valid JSON", "resp": None},
+                    status=400)
+            if not isinstance(data, dict):
+                return web.json_response(
+                    {"err": "Request body must be a JSON object", "resp": None},
+                    status=400)
+        try:
+            response = await gateway_table.post(request.match_info["endpoint"], data)
+        except Exception as e:
+            return web.json_response({"err": str(e), "resp": None}, status=502)
+        return web.json_response({"err": None, "resp": response})
+
+    def _get_gateway_table(self, request: web.Request) -> "_GatewayTable":
+        gateway_table = self._tables.get(request.match_info["id"])
+        if gateway_table is None:
+            raise web.HTTPNotFound()
+        return gateway_table
+
+
+class _GatewayTable:
+    def __init__(self, table: Table, max_backlog: int):
+        self.table = table
+        self._max_backlog = max_backlog
+        self._subscribers: Set[_Subscriber] = set()
+        self._version = 0
+        self._state: Snapshot = {}
+        self._changes: Snapshot = {}
+        self._in_flight: Dict[Tuple[str, str], "asyncio.Future[Any]"] = {}
+
+    def start(self) -> None:
+        self._state = snapshot_collection(self.table._collection)
+        self._state["track_time"] = self._track_time()
+        self.table._collection.add_change_listener(self._on_model_changed)
+        self.table.add_listener(self._on_change)
+
+    async def stop(self) -> None:
+        self.table._collection.remove_change_listener(self._on_model_changed)
+        self.table.remove_listener(self._on_change)
+        for subscriber in list(self._subscribers):
+            await self.unsubscribe(subscriber)
+
+    def snapshot_message(self) -> Dict[str, Any]:
+        return {"type": "snapshot", "version": self._version, "state": self._state}
+
+    def subscribe(self, ws: web.WebSocketResponse) -> "_Subscriber":
+        subscriber = _Subscriber(ws, self._max_backlog)
+        # Serialized now, since the state is updated in place
+        subscriber.send(json.dumps(self.snapshot_message()))
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    async def unsubscribe(self, subscriber: "_Subscriber") -> None:
+        self._subscribers.discard(subscriber)
+        await subscriber.close()
+
+    async def post(self, endpoint: str, data: Optional[Dict[str, Any]]) -> Any:
+        key = (endpoint, json.dumps(data, sort_keys=True))
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(
+                self.table._get_transport().post(endpoint, data))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def _on_model_changed(self, model_id: Any, changes: Dict[str, Any]) -> None:
+        model_id = str(model_id)
+        self._state.setdefault(model_id, {}).update(changes)
+        self._changes.setdefault(model_id, {}).update(changes)
+
+    def _on_change(self) -> None:
+        track_time = self._track_time()
+        if track_time != self._state.get("track_time"):
+            self._state["track_time"] = track_time
+            self._changes["track_time"] = track_time
+        if not self._changes:
+            return
+
+        self._version += 1
+        message = json.dumps(
+            {"type": "delta", "version": self._version, "changes": self._changes})
+        self._changes = {}
+        for subscriber in list(self._subscribers):
+            if not subscriber.send(message):
+                _LOGGER.debug("Dropping gateway subscriber that fell behind")
+                self._subscribers.discard(subscriber)
+                asyncio.ensure_future(subscriber.close())
+
+    def _track_time(self) -> Dict[str, Any]:
+        as_of = self.table.active_track_remaining_time_as_of
+        return {
+            "remaining_time": self.table.active_track_remaining_time.total_seconds() * 1000,
+            "total_time": self.table.active_track_total_time.total_seconds() * 1000,
+            "as_of": as_of.isoformat() if as_of else None,
+        }
+
+
+class _Subscriber:
+    """One WebSocket client, with its own queue drained by its own task"""
+
+    def __init__(self, ws: web.WebSocketResponse, max_backlog: int):
+        self._ws = ws
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue(max_backlog)
+        self._sender = asyncio.ensure_future(self._send_all())
+
+    def send(self, message: str) -> bool:
+        """Queue message; False if the client is too far behind"""
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def close(self) -> None:
+        self._sender.cancel()
+        try:
+            await self._sender
+        except asyncio.CancelledError:
+            pass
+        await self._ws.close()
+
+    async def _send_all(self) -> None:
+        while True:
+            message = await self._queue.get()
+            try:
+                await self._ws.send_str(message)
+            except Exception as e:
+                _LOGGER.debug("Dropping gateway subscriber: %s", e)
+                await self._ws.close()
+                return
+
+
+if __name__ == "__main__":
+    import aiounittest
+    import unittest
+
+    from aiohttp.test_utils import TestClient, TestServer
+
+    from .loopback import SimulatedSisbot
+
+    class StalledWebSocket:
+        def __init__(self):
+            self.closed = False
+
+        async def send_str(self, message: str) -> None:
+            await asyncio.Event().wait()
+
+        async def close(self) -> None:
+            self.closed = True
+
+    class TableGatewayTests(aiounittest.AsyncTestCase):
+        async def connect(self) -> Table:
+            sisbot = SimulatedSisbot(id="sisbot")
+            return await Table.connect(
+                "loopback", transport_factory=sisbot.transport_factory())
+
+        async def test_malformed_command_body(self) -> None:
+            table = await self.connect()
+            gateway = TableGateway([table])
+            async with TestClient(TestServer(gateway.app)) as client:
+                for body in ["{not json", "[1, 2]"]:
+                    response = await client.post(
+                        "/tables/sisbot/commands/set_speed",
+                        data=body,
+                        headers={"Content-Type": "application/json"})
+                    self.assertEqual(response.status, 400)
+                    self.assertIsNotNone((await response.json())["err"])
+            await table.close()
+
+        async def test_optimistic_change_sends_delta(self) -> None:
+            table = await self.connect()
+            gateway = TableGateway([table])
+            gateway._tables["sisbot"].start()
+            async with TestClient(TestServer(gateway.app)) as client:
+                ws = await client.ws_connect("/tables/sisbot/events")
+                snapshot = await ws.receive_json()
+                self.assertEqual(snapshot["type"], "snapshot")
+
+                await table.set_speed(0.8)
+                delta = await ws.receive_json()
+                self.assertEqual(delta["version"], snapshot["version"] + 1)
+                self.assertEqual(delta["changes"], {"sisbot": {"speed": 0.8}})
+                await ws.close()
+            await gateway._tables["sisbot"].stop()
+            await table.close()
+
+        async def test_stalled_subscriber_is_dropped(self) -> None:
+            table = await self.connect()
+            gateway_table = _GatewayTable(table, max_backlog=3)
+            gateway_table.start()
+            ws = StalledWebSocket()
+            gateway_table.subscribe(ws)  # type: ignore
+
+            for i in range(5):
+                await asyncio.wait_for(table.set_speed(i / 10), 1)
+            await asyncio.sleep(0)
+
+            self.assertEqual(len(gateway_table._subscribers), 0)
+            self.assertTrue(ws.closed)
+            await gateway_table.stop()
+            await table.close()
+
+    unittest.main()
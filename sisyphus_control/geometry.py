@@ -0,0 +1,182 @@
+r"""
+Parsing of theta-rho (.thr) track files. Requires numpy, which is an optional
+dependency (install the ``geometry`` extra).
+
+A .thr file has one vertex per line: the ball's angle in radians (not wrapped
+to 2*pi) and its distance from the center, from 0 to 1. Lines starting with #
+are comments.
+"""
+
+from typing import IO, Iterable, Iterator, List, Tuple, Union
+
+import io
+import os
+
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 4096
+
+
+class TrackGeometry:
+    """The path the ball follows for one track, as parallel arrays of theta
+and rho values."""
+
+    def __init__(self, theta: np.ndarray, rho: np.ndarray):
+        if theta.shape != rho.shape:
+            raise ValueError("theta and rho must have the same shape")
+        self._theta = theta
+        self._rho = rho
+
+    def __len__(self) -> int:
+        return len(self._theta)
+
+    @property
+    def theta(self) -> np.ndarray:
+        return self._theta
+
+    @property
+    def rho(self) -> np.ndarray:
+        return self._rho
+
+    @property
+    def path_length(self) -> float:
+        """Approximate distance travelled by the ball, in table radii. Each
+segment is a spiral in Cartesian space; its length is approximated from the
+radial and (mean-radius) angular components."""
+        if len(self._theta) < 2:
+            return 0.0
+        mean_rho = (self._rho[:-1] + self._rho[1:]) / 2
+        return float(np.sum(np.hypot(
+            np.diff(self._rho),
+            np.diff(self._theta) * mean_rho)))
+
+    def to_cartesian(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (x, y) arrays with the table center at the origin and the
+edge at distance 1."""
+        return self._rho * np.cos(self._theta), self._rho * np.sin(self._theta)
+
+
+def iter_thr_chunks(
+        lines: Iterable[str],
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[np.ndarray]:
+    """Parses .thr lines, yielding (n, 2) arrays of at most chunk_size
+vertices so that only one chunk of text is held at a time."""
+    values: List[str] = []
+    line_number = 0
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise ValueError(
+                "Line {line_number} of .thr data has {count} values, expected 2".format(
+                    line_number=line_number, count=len(fields)))
+        values.extend(fields)
+        if len(values) >= 2 * chunk_size:
+            yield _parse_chunk(values, line_number)
+            values = []
+
+    if values:
+        yield _parse_chunk(values, line_number)
+
+
+def parse_thr(
+        source: Union[str, "os.PathLike[str]", IO[str]],
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> TrackGeometry:
+    """Parses a .thr file from a path or an open text stream."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "r") as f:
+            return parse_thr(f, chunk_size)
+    return _parse_lines(source, chunk_size)
+
+
+def parse_thr_string(text: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> TrackGeometry:
+    """Parses .thr data that is already in memory, one line at a time
+without copying the text"""
+    return _parse_lines(_iter_lines(text), chunk_size)
+
+
+def _parse_lines(lines: Iterable[str], chunk_size: int) -> TrackGeometry:
+    # Grow a single buffer rather than concatenating a list of chunks, so
+    # peak memory is bounded by the buffer plus one chunk
+    vertices = np.empty((chunk_size, 2))
+    count = 0
+    for chunk in iter_thr_chunks(lines, chunk_size):
+        if count + len(chunk) > len(vertices):
+            vertices = np.resize(
+                vertices, (max(2 * len(vertices), count + len(chunk)), 2))
+        vertices[count:count + len(chunk)] = chunk
+        count += len(chunk)
+
+    vertices = vertices[:count]
+    return TrackGeometry(vertices[:, 0].copy(), vertices[:, 1].copy())
+
+
+def _iter_lines(text: str) -> Iterator[str]:
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start)
+        if end == -1:
+            end = len(text)
+        yield text[start:end]
+        start = end + 1
+
+
+def _parse_chunk(values: List[str], line_number: int) -> np.ndarray:
+    try:
+        return np.array(values, dtype=np.float64).reshape(-1, 2)
+    except ValueError as e:
+        raise ValueError(
+            "Invalid .thr data before line {line_number}: {error}".format(
+                line_number=line_number, error=e)) from e
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class ParseThrTests(unittest.TestCase):
+        def test_skips_comments_and_blank_lines(self) -> None:
+            geometry = parse_thr_string(
+                "# header\n\n0 0\n  # indented comment\n1.5 0.5\r\n\n3 1")
+            self.assertEqual(geometry.theta.tolist(), [0, 1.5, 3])
+            self.assertEqual(geometry.rho.tolist(), [0, 0.5, 1])
+
+        def test_chunk_boundaries(self) -> None:
+            text = "".join(
+                "{theta} {rho}\n".format(theta=i, rho=i / 10) for i in range(11))
+            chunks = list(iter_thr_chunks(_iter_lines(text), chunk_size=4))
+            self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 3])
+
+            for chunk_size in (1, 2, 4, 10, 11, 12):
+                geometry = parse_thr_string(text, chunk_size=chunk_size)
+                self.assertEqual(geometry.theta.tolist(), list(range(11)))
+
+        def test_string_matches_stream(self) -> None:
+            text = "# comment\n0 0\n1 0.25\n2 1\n"
+            from_string = parse_thr_string(text, chunk_size=2)
+            from_stream = parse_thr(io.StringIO(text), chunk_size=2)
+            self.assertEqual(from_string.theta.tolist(), from_stream.theta.tolist())
+            self.assertEqual(from_string.rho.tolist(), from_stream.rho.tolist())
+
+        def test_empty(self) -> None:
+            geometry = parse_thr_string("# nothing here\n")
+            self.assertEqual(len(geometry), 0)
+            self.assertEqual(geometry.path_length, 0.0)
+
+        def test_malformed_lines(self) -> None:
+            for text in [
+                    "0 0\n1\n",
+                    "0 0\n1 2 3\n",
+                    # Extra and missing values that cancel out
+                    "0 0 0\n1\n",
+                    "0 0\none 1\n"]:
+                with self.subTest(text=text):
+                    with self.assertRaises(ValueError):
+                        parse_thr_string(text)
+
+        def test_malformed_line_is_reported(self) -> None:
+            with self.assertRaisesRegex(ValueError, "Line 3"):
+                parse_thr_string("0 0\n# comment\n1\n")
+
+    unittest.main()
@@ -0,0 +1,223 @@
+from collections import deque
+from enum import Enum
+from typing import Awaitable, Callable, Deque, Optional
+
+import asyncio
+import logging
+import time
+import zlib
+
+_LOGGER = logging.getLogger("sisyphus-control")
+
+
+class HealthState(Enum):
+    UNKNOWN = "unknown"
+    HEALTHY = "healthy"
+    DEGRADED = "degraded"
+    OFFLINE = "offline"
+
+
+HealthCallback = Callable[[HealthState], Awaitable[None]]
+
+
+class HealthMonitor:
+    """Pings a table every interval seconds and tracks its health.
+
+The table is DEGRADED if the last ping failed or the smoothed latency is above
+degraded_latency, and OFFLINE once no ping has succeeded for offline_after
+seconds, so a table that drops off the network is marked offline within
+offline_after + interval seconds. Each table's first ping is offset by a
+fraction of the interval derived from its IP, so the heartbeats of a fleet are
+spread out instead of firing together."""
+
+    def __init__(
+            self,
+            ip: str,
+            ping: Callable[[float], Awaitable[None]],
+            callback: Optional[HealthCallback] = None,
+            interval: float = 10.0,
+            timeout: float = 2.0,
+            degraded_latency: float = 1.0,
+            offline_after: float = 30.0,
+            ewma_alpha: float = 0.2,
+            window: int = 100):
+        self._ip = ip
+        self._ping = ping
+        self._callback = callback
+        self._interval = interval
+        self._timeout = timeout
+        self._degraded_latency = degraded_latency
+        self._offline_after = offline_after
+        self._ewma_alpha = ewma_alpha
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._latency_ewma: Optional[float] = None
+        self._last_success: Optional[float] = None
+        self._started_at = time.monotonic()
+        self._consecutive_failures = 0
+        self._state = HealthState.UNKNOWN
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def state(self) -> HealthState:
+        return self._state
+
+    @property
+    def latency_ewma(self) -> Optional[float]:
+        """Exponentially weighted moving average of ping round-trip time, in
+seconds"""
+        return self._latency_ewma
+
+    @property
+    def consecutive_failures(self) -> int:
+        return self._consecutive_failures
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """Round-trip time percentile (0-100) over recent pings, in seconds"""
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        index = round(percentile / 100 * (len(latencies) - 1))
+        return latencies[max(0, min(index, len(latencies) - 1))]
+
+    def start(self) -> None:
+        if self._task is None:
+            self._started_at = time.monotonic()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def beat(self) -> HealthState:
+        """Ping once and update the health state"""
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._ping(self._timeout), self._timeout)
+        except Exception as e:
+            _LOGGER.debug("Heartbeat to %s failed: %s", self._ip, e)
+            self._consecutive_failures += 1
+        else:
+            now = time.monotonic()
+            latency = now - start
+            self._latencies.append(latency)
+            if self._latency_ewma is None:
+                self._latency_ewma = latency
+            else:
+                self._latency_ewma += self._ewma_alpha * (latency - self._latency_ewma)
+            self._last_success = now
+            self._consecutive_failures = 0
+
+        await self._set_state(self._evaluate())
+        return self._state
+
+    async def _run(self) -> None:
+        await asyncio.sleep(self._spread_offset())
+        while True:
+            started = time.monotonic()
+            await self.beat()
+            await asyncio.sleep(max(0.0, self._interval - (time.monotonic() - started)))
+
+    def _spread_offset(self) -> float:
+        return (zlib.crc32(self._ip.encode()) % 1000) / 1000 * self._interval
+
+    def _evaluate(self) -> HealthState:
+        last_success = self._last_success
+        if last_success is None:
+            last_success = self._started_at
+        if (self._consecutive_failures > 0
+                and time.monotonic() - last_success >= self._offline_after):
+            return HealthState.OFFLINE
+        if self._consecutive_failures > 0:
+            return HealthState.DEGRADED
+        if self._latency_ewma is not None and self._latency_ewma > self._degraded_latency:
+            return HealthState.DEGRADED
+        return HealthState.HEALTHY
+
+    async def _set_state(self, state: HealthState) -> None:
+        if state == self._state:
+            return
+        _LOGGER.info("%s is now %s", self._ip, state.value)
+        self._state = state
+        if self._callback is not None:
+            await self._callback(state)
+
+
+if __name__ == "__main__":
+    import aiounittest
+    import unittest
+    from typing import List
+
+    class HealthMonitorTests(aiounittest.AsyncTestCase):
+        async def test_failure_degraded_offline_recovered(self) -> None:
+            states: List[HealthState] = []
+            reachable = True
+
+            async def ping(timeout: float) -> None:
+                if not reachable:
+                    raise Exception("Unreachable")
+
+            async def callback(state: HealthState) -> None:
+                states.append(state)
+
+            monitor = HealthMonitor("test", ping, callback, offline_after=0.05)
+            self.assertEqual(monitor.state, HealthState.UNKNOWN)
+            self.assertEqual(await monitor.beat(), HealthState.HEALTHY)
+
+            reachable = False
+            self.assertEqual(await monitor.beat(), HealthState.DEGRADED)
+            self.assertEqual(monitor.consecutive_failures, 1)
+            await asyncio.sleep(0.06)
+            self.assertEqual(await monitor.beat(), HealthState.OFFLINE)
+            self.assertEqual(await monitor.beat(), HealthState.OFFLINE)
+            self.assertEqual(monitor.consecutive_failures, 3)
+
+            reachable = True
+            self.assertEqual(await monitor.beat(), HealthState.HEALTHY)
+            self.assertEqual(monitor.consecutive_failures, 0)
+            # Only changes are reported
+            self.assertEqual(states, [
+                HealthState.HEALTHY,
+                HealthState.DEGRADED,
+                HealthState.OFFLINE,
+                HealthState.HEALTHY])
+
+        async def test_slow_pings_degrade(self) -> None:
+            async def ping(timeout: float) -> None:
+                await asyncio.sleep(0.05)
+
+            monitor = HealthMonitor("test", ping, degraded_latency=0.01)
+            self.assertEqual(await monitor.beat(), HealthState.DEGRADED)
+            self.assertEqual(monitor.consecutive_failures, 0)
+            self.assertGreaterEqual(monitor.latency_ewma, 0.04)  # type: ignore
+
+        async def test_timed_out_ping_fails(self) -> None:
+            async def ping(timeout: float) -> None:
+                await asyncio.sleep(1)
+
+            monitor = HealthMonitor("test", ping, timeout=0.01)
+            self.assertEqual(await monitor.beat(), HealthState.DEGRADED)
+            self.assertEqual(monitor.consecutive_failures, 1)
+            self.assertIsNone(monitor.latency_percentile(50))
+
+    class LatencyPercentileTests(unittest.TestCase):
+        def test_percentiles(self) -> None:
+            async def ping(timeout: float) -> None:
+                pass
+
+            monitor = HealthMonitor("test", ping, window=10)
+            self.assertIsNone(monitor.latency_percentile(50))
+            for latency in range(20, 0, -1):
+                monitor._latencies.append(latency / 100)
+
+            # Only the last window (0.10 down to 0.01) counts
+            self.assertEqual(monitor.latency_percentile(0), 0.01)
+            self.assertEqual(monitor.latency_percentile(50), 0.05)
+            self.assertEqual(monitor.latency_percentile(100), 0.10)
+            self.assertEqual(monitor.latency_percentile(150), 0.10)
+
+    unittest.main()
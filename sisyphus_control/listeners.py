@@ -0,0 +1,126 @@
+from types import TracebackType
+from typing import Any, Awaitable, Callable, Optional, Tuple, Type, Union
+
+import inspect
+import weakref
+
+Listener = Union[Callable[..., None], Callable[..., Awaitable[None]]]
+
+
+class Subscription:
+    """Returned by ListenerRegistry.add. Call remove() or use as a context
+manager to unsubscribe."""
+
+    def __init__(self, registry: "ListenerRegistry", entry: "_Entry"):
+        self._registry = weakref.ref(registry)
+        self._entry = entry
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(
+            self,
+            exc_type: Optional[Type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType]) -> bool:
+        self.remove()
+        return False
+
+    @property
+    def is_active(self) -> bool:
+        registry = self._registry()
+        return registry is not None and registry._contains(self._entry)
+
+    def remove(self) -> None:
+        """Unsubscribe; does nothing if already unsubscribed"""
+        registry = self._registry()
+        if registry is not None:
+            registry._remove_entry(self._entry)
+
+
+class ListenerRegistry:
+    """An ordered set of listeners, optionally held by weak reference so that
+subscribers that are garbage collected are dropped automatically.
+
+Listeners are kept in a tuple that is replaced, never mutated, when a
+listener is added or removed, so notification iterates it without copying
+and listeners may safely add or remove listeners while being notified."""
+
+    def __init__(self):
+        self._entries: Tuple[_Entry, ...] = ()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, listener: Listener, weak: bool = False) -> Subscription:
+        """Add a listener. With weak, only a weak reference is kept; bound
+methods are referenced through their object, so pass weak=True for methods
+of objects that may go away without removing their listener. (A lambda or
+other function that nothing else references would be dropped immediately.)"""
+        entry = _Entry(listener, weak, self._on_collected)
+        self._entries = self._entries + (entry,)
+        return Subscription(self, entry)
+
+    def remove(self, listener: Listener) -> None:
+        for entry in self._entries:
+            if entry.resolve() == listener:
+                self._remove_entry(entry)
+                return
+        raise ValueError("Listener is not registered")
+
+    async def notify(self, *args: Any) -> None:
+        """Call every listener with args"""
+        for entry in self._entries:
+            listener = entry.resolve()
+            if listener is None:
+                continue
+            if entry.is_coroutine:
+                await listener(*args)  # type: ignore
+            else:
+                listener(*args)
+
+    def _contains(self, entry: "_Entry") -> bool:
+        return entry in self._entries
+
+    def _remove_entry(self, entry: "_Entry") -> None:
+        self._entries = tuple(e for e in self._entries if e is not entry)
+
+    def _on_collected(self, entry: "_Entry") -> None:
+        self._remove_entry(entry)
+
+
+class _Entry:
+    __slots__ = ["_listener", "_ref", "is_coroutine", "__weakref__"]
+
+    def __init__(
+            self,
+            listener: Listener,
+            weak: bool,
+            on_collected: Callable[["_Entry"], None]):
+        self.is_coroutine = inspect.iscoroutinefunction(listener)
+        self._listener: Optional[Listener] = None
+        self._ref: Optional[Callable[[], Optional[Listener]]] = None
+        if not weak:
+            self._listener = listener
+            return
+
+        # The callback must not keep the registry alive, so it holds the
+        # registry's method weakly as well
+        callback_ref = weakref.WeakMethod(on_collected)  # type: ignore
+        entry_ref = weakref.ref(self)
+
+        def collected(_: Any) -> None:
+            callback = callback_ref()
+            entry = entry_ref()
+            if callback is not None and entry is not None:
+                callback(entry)
+
+        if inspect.ismethod(listener):
+            self._ref = weakref.WeakMethod(listener, collected)  # type: ignore
+        else:
+            self._ref = weakref.ref(listener, collected)
+
+    def resolve(self) -> Optional[Listener]:
+        if self._ref is not None:
+            return self._ref()
+        return self._listener
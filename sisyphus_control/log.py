@@ -1,6 +1,5 @@
 from typing import Dict, Any
 
-import difflib
 import logging
 
 from .data import Model
@@ -9,6 +8,11 @@ _LOGGER = logging.getLogger("sisyphus-control")
 
 
 def log_data_change(old: Model, new: Model) -> None:
+    if not _LOGGER.isEnabledFor(logging.DEBUG):
+        return
+
+    import difflib
+
     if old == None:
         old = Model({})
 
@@ -0,0 +1,464 @@
+r"""
+An in-process stand-in for a table, for tests, simulations and embedding.
+
+SimulatedSisbot keeps the same kinds of models a real sisbot reports and
+answers the endpoints this library uses. LoopbackTransport calls it directly:
+nothing is serialized and nothing goes over the network. Every Table
+connected to the same SimulatedSisbot receives its state changes, as tables
+connected to a real sisbot do over socket.io::
+
+    sisbot = SimulatedSisbot()
+    sisbot.add_track("hep", "Hep", "0 0\\n3.14 1\\n")
+    table = await Table.connect("sim", transport_factory=sisbot.transport_factory())
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import uuid
+
+from .scheduler import Priority
+from .transport import Transport, TransportCallback, TransportFactory
+
+Models = List[Dict[str, Any]]
+
+
+class SimulatedSisbot:
+    def __init__(self, name: str = "Simulated Table", id: Optional[str] = None):
+        self._transports: Set["LoopbackTransport"] = set()
+        self._verts: Dict[str, str] = {}
+        self._sisbot: Dict[str, Any] = {
+            "id": id or str(uuid.uuid4()),
+            "type": "sisbot",
+            "name": name,
+            "state": "waiting",
+            "is_sleeping": "false",
+            "is_shuffle": "false",
+            "is_loop": "false",
+            "brightness": 0.5,
+            "speed": 0.3,
+            "playlist_ids": [],
+            "track_ids": [],
+            "active_playlist_id": "false",
+            "active_track": {"id": "false"},
+            "software_version": "simulated",
+        }
+        self._models: Dict[str, Dict[str, Any]] = {self._sisbot["id"]: self._sisbot}
+        self._remaining_time = 0
+        self._total_time = 0
+
+        self._handlers: Dict[str, Callable[[Dict[str, Any]], Models]] = {
+            "connect": self._all_models,
+            "state": self._all_models,
+            "exists": lambda data: [dict(self._sisbot)],
+            "play": lambda data: self._set_sisbot(state="playing"),
+            "pause": lambda data: self._set_sisbot(state="paused"),
+            "sleep_sisbot": lambda data: self._set_sisbot(is_sleeping="true"),
+            "wake_sisbot": lambda data: self._set_sisbot(is_sleeping="false"),
+            "set_speed": lambda data: self._set_sisbot(speed=float(data["value"])),
+            "set_brightness": lambda data: self._set_sisbot(brightness=float(data["value"])),
+            "set_loop": lambda data: self._set_sisbot(is_loop=data["value"]),
+            "set_shuffle": self._set_shuffle,
+            "set_playlist": self._set_playlist,
+            "set_track": self._set_track,
+            "add_playlist": self._add_playlist,
+            "get_track_time": lambda data: [{
+                "remaining_time": self._remaining_time,
+                "total_time": self._total_time}],
+            "get_track_verts": lambda data: self._verts[data["id"]],  # type: ignore
+        }
+
+    @property
+    def sisbot(self) -> Dict[str, Any]:
+        return self._sisbot
+
+    def transport_factory(self) -> TransportFactory:
+        """For Table.connect(..., transport_factory=...)"""
+        return lambda ip, callback: LoopbackTransport(self, callback, ip)
+
+    def add_track(self, id: str, name: str, verts: str = "") -> Dict[str, Any]:
+        track = {"id": id, "type": "track", "name": name}
+        self._models[id] = track
+        self._verts[id] = verts
+        self._sisbot["track_ids"] = self._sisbot["track_ids"] + [id]
+        return track
+
+    def add_playlist(self, id: str, name: str, track_ids: List[str]) -> Dict[str, Any]:
+        playlist = {
+            "id": id,
+            "type": "playlist",
+            "name": name,
+            "description": "",
+            "version": 1,
+            "created_at": "2020-01-01 00:00:00",
+            "updated_at": "2020-01-01 00:00:00",
+            "is_loop": "false",
+            "is_shuffle": "false",
+            "active_track_index": -1,
+            "active_track_id": "false",
+            "tracks": [
+                dict(self._models[track_id], _index=index)
+                for index, track_id in enumerate(track_ids)],
+            "sorted_tracks": list(range(len(track_ids))),
+        }
+        self._models[id] = playlist
+        self._sisbot["playlist_ids"] = self._sisbot["playlist_ids"] + [id]
+        return playlist
+
+    def set_track_time(self, remaining_ms: int, total_ms: int) -> None:
+        self._remaining_time = remaining_ms
+        self._total_time = total_ms
+
+    async def handle(self, endpoint: str, data: Optional[Dict[str, Any]]) -> Any:
+        handler = self._handlers.get(endpoint)
+        if handler is None:
+            raise Exception("Unknown endpoint {endpoint}".format(endpoint=endpoint))
+        return handler(data or {})
+
+    async def push(self, models: Models, source: Optional["LoopbackTransport"] = None) -> None:
+        """Send changed models to every connected transport except source, as
+the sisbot's socket.io "set" event does"""
+        for transport in list(self._transports):
+            if transport is not source:
+                await transport._deliver(models)
+
+    def _all_models(self, data: Dict[str, Any]) -> Models:
+        return [dict(model) for model in self._models.values()]
+
+    def _set_sisbot(self, **changes: Any) -> Models:
+        # Values are replaced rather than mutated, so models handed out
+        # earlier are never changed underneath their holders
+        self._sisbot.update(changes)
+        return [dict(self._sisbot)]
+
+    def _set_shuffle(self, data: Dict[str, Any]) -> Models:
+        changed = self._set_sisbot(is_shuffle=data["value"])
+        playlist = self._models.get(self._sisbot["active_playlist_id"])
+        if playlist is not None:
+            playlist["is_shuffle"] = data["value"]
+            changed.append(dict(playlist))
+        return changed
+
+    def _set_playlist(self, data: Dict[str, Any]) -> Models:
+        playlist = self._models[data["id"]]
+        playlist.update({key: value for key, value in data.items() if key != "tracks"})
+        index = max(0, playlist["active_track_index"])
+        playlist["active_track_index"] = index
+        track = playlist["tracks"][index] if playlist["tracks"] else {"id": "false"}
+        playlist["active_track_id"] = track["id"]
+        return [dict(playlist)] + self._set_sisbot(
+            active_playlist_id=playlist["id"],
+            active_track=dict(track),
+            state="playing")
+
+    def _set_track(self, data: Dict[str, Any]) -> Models:
+        return self._set_sisbot(
+            active_playlist_id="false",
+            active_track=dict(self._models[data["id"]]),
+            state="playing")
+
+    def _add_playlist(self, data: Dict[str, Any]) -> Models:
+        playlist = self._models.setdefault(data["id"], {"id": data["id"], "type": "playlist"})
+        playlist.update(data)
+        playlist["version"] = int(playlist.get("version", 0)) + 1
+        return [dict(playlist)]
+
+
+class LoopbackTransport(Transport):
+    def __init__(
+            self,
+            sisbot: SimulatedSisbot,
+            callback: Optional[TransportCallback] = None,
+            ip: str = "loopback"):
+        self._sisbot = sisbot
+        self._callback = callback
+        self._ip = ip
+        sisbot._transports.add(self)
+
+    @property
+    def ip(self) -> str:
+        return self._ip
+
+    async def post(
+        self,
+        endpoint: str,
+        data: Optional[Dict[str, Any]] = None,
+        timeout: float = 5,
+        priority: Priority = Priority.INTERACTIVE,
+        fail_fast: Optional[bool] = None,
+    ) -> Any:
+        response = await self._sisbot.handle(endpoint, data)
+        if isinstance(response, list):
+            await self._deliver(response)
+            await self._sisbot.push(response, source=self)
+        return response
+
+    async def close(self) -> None:
+        self._sisbot._transports.discard(self)
+
+    async def _deliver(self, models: Models) -> None:
+        if self._callback is not None:
+            await self._callback(models)
+
+
+if __name__ == "__main__":
+    import aiounittest
+    import asyncio
+    import unittest
+
+    from .table import Table
+
+    class TableTests(aiounittest.AsyncTestCase):
+        async def connect(self) -> "Table":
+            self.sisbot = sisbot = SimulatedSisbot()
+            sisbot.add_track("t1", "One", "0 0\n1 1\n")
+            sisbot.add_track("t2", "Two", "0 0\n1 1\n")
+            sisbot.add_playlist("p1", "Playlist", ["t1", "t2"])
+            return await Table.connect(
+                "loopback", transport_factory=sisbot.transport_factory())
+
+        async def test_set_shuffle_on_active_playlist(self) -> None:
+            table = await self.connect()
+            playlist = table.get_playlist_by_id("p1")
+            await playlist.play()
+            notifications = []
+            table.add_listener(lambda: notifications.append(table.is_shuffle))
+
+            await table.set_shuffle(True)
+
+            self.assertTrue(table.is_shuffle)
+            self.assertTrue(table.active_playlist.is_shuffle)  # type: ignore
+            # No rollback notification back to False
+            self.assertNotIn(False, notifications)
+            await table.close()
+
+        async def test_set_shuffle_without_active_playlist_raises(self) -> None:
+            table = await self.connect()
+            with self.assertRaises(Exception):
+                await table.set_shuffle(True)
+            self.assertFalse(table.is_shuffle)
+            await table.close()
+
+        async def test_edit_keeps_shuffled_play_order(self) -> None:
+            sisbot = SimulatedSisbot()
+            for track_id, name in [("t1", "One"), ("t2", "Two"), ("t3", "Three")]:
+                sisbot.add_track(track_id, name)
+            data = sisbot.add_playlist("p1", "Playlist", ["t1", "t2", "t3"])
+            data["is_shuffle"] = "true"
+            data["sorted_tracks"] = [2, 0, 1]
+            table = await Table.connect(
+                "loopback", transport_factory=sisbot.transport_factory())
+            other = await Table.connect(
+                "loopback", transport_factory=sisbot.transport_factory())
+            playlist = table.get_playlist_by_id("p1")
+            self.assertEqual(
+                [track.name for track in playlist.tracks], ["Three", "One", "Two"])
+
+            async with playlist.edit() as edit:
+                edit.move(playlist.tracks[1], 0)
+
+            for p in (playlist, other.get_playlist_by_id("p1")):
+                self.assertTrue(p.is_shuffle)
+                self.assertEqual(
+                    [track.name for track in p.tracks], ["One", "Three", "Two"])
+            self.assertEqual(playlist._data["sorted_tracks"], [0, 2, 1])
+            await table.close()
+            await other.close()
+
+        async def test_edit_unshuffled_playlist(self) -> None:
+            table = await self.connect()
+            playlist = table.get_playlist_by_id("p1")
+            async with playlist.edit() as edit:
+                edit.move(playlist.tracks[1], 0)
+                edit.add(table.get_track_by_id("t1"))
+            self.assertEqual(
+                [track.id for track in playlist.tracks], ["t2", "t1", "t1"])
+            self.assertEqual(playlist._data["sorted_tracks"], [0, 1, 2])
+
+            async with playlist.edit() as edit:
+                edit.remove(playlist.tracks[0])
+            self.assertEqual([track.id for track in playlist.tracks], ["t1", "t1"])
+            await table.close()
+
+        def count_requests(self, endpoint: str) -> Dict[str, int]:
+            """Counts requests to endpoint, and the most in flight at once"""
+            counts = {"total": 0, "in_flight": 0, "max_in_flight": 0}
+            handle = self.sisbot.handle
+
+            async def counting_handle(name: str, data: Optional[Dict[str, Any]]) -> Any:
+                if name != endpoint:
+                    return await handle(name, data)
+                counts["total"] += 1
+                counts["in_flight"] += 1
+                counts["max_in_flight"] = max(counts["max_in_flight"], counts["in_flight"])
+                try:
+                    await asyncio.sleep(0.01)
+                    return await handle(name, data)
+                finally:
+                    counts["in_flight"] -= 1
+
+            self.sisbot.handle = counting_handle  # type: ignore
+            return counts
+
+        async def test_track_time_calibrates_duration_model(self) -> None:
+            table = await self.connect()
+            table.enable_calibration()
+            self.sisbot.set_track_time(remaining_ms=60000, total_ms=90000)
+            await table.get_track_by_id("t1").play()  # type: ignore
+            await table.refresh()
+            await asyncio.gather(*table._background_tasks)
+
+            model = table.duration_model
+            self.assertEqual(model.sample_count, 1)
+            self.assertIsNotNone(model.get_path_length("t1"))
+            await table.close()
+
+        async def test_calibration_downloads_are_opt_in(self) -> None:
+            table = await self.connect()
+            downloads = self.count_requests("get_track_verts")
+            self.sisbot.set_track_time(remaining_ms=60000, total_ms=90000)
+            await table.get_track_by_id("t1").play()  # type: ignore
+            await table.refresh()
+            self.assertEqual(len(table._background_tasks), 0)
+            self.assertEqual(downloads["total"], 0)
+            self.assertEqual(table.duration_model.sample_count, 0)
+
+            # A path length that is already known is used without downloading
+            table.duration_model.set_path_length("t1", 10.0)
+            self.sisbot.set_track_time(remaining_ms=50000, total_ms=95000)
+            await table.refresh()
+            self.assertEqual(table.duration_model.sample_count, 1)
+            self.assertEqual(downloads["total"], 0)
+            await table.close()
+
+        async def test_estimate_downloads_are_bounded(self) -> None:
+            sisbot = self.sisbot = SimulatedSisbot()
+            track_ids = ["t{i}".format(i=i) for i in range(10)]
+            for track_id in track_ids:
+                sisbot.add_track(track_id, track_id, "0 0\n1 1\n")
+            sisbot.add_playlist("p1", "Playlist", track_ids)
+            table = await Table.connect(
+                "loopback", transport_factory=sisbot.transport_factory())
+            downloads = self.count_requests("get_track_verts")
+
+            playlist = table.get_playlist_by_id("p1")
+            duration = await playlist.estimate_total_duration()  # type: ignore
+            self.assertGreater(duration.total_seconds(), 0)
+            self.assertEqual(downloads["total"], 10)
+            self.assertLessEqual(downloads["max_in_flight"], 2)
+
+            # Path lengths are cached now
+            await playlist.estimate_total_duration()  # type: ignore
+            self.assertEqual(downloads["total"], 10)
+            await table.close()
+
+        async def connect_three(self) -> "Table":
+            self.sisbot = sisbot = SimulatedSisbot()
+            for track_id, name in [("t1", "One"), ("t2", "Two"), ("t3", "Three")]:
+                sisbot.add_track(track_id, name, "0 0\n1 1\n")
+            self.playlist_data = sisbot.add_playlist("p1", "Playlist", ["t1", "t2", "t3"])
+            return await Table.connect(
+                "loopback", transport_factory=sisbot.transport_factory())
+
+        async def test_playback_order_is_reused_after_reshuffle(self) -> None:
+            table = await self.connect_three()
+            before = table.get_playlist_by_id("p1").tracks  # type: ignore
+            order = table._playback_orders["p1"]
+
+            self.playlist_data.update(is_shuffle="true", sorted_tracks=[2, 0, 1])
+            await self.sisbot.push([dict(self.playlist_data)])
+            after = table.get_playlist_by_id("p1").tracks  # type: ignore
+            self.assertEqual([track.name for track in after], ["Three", "One", "Two"])
+            self.assertIs(table._playback_orders["p1"], order)
+            self.assertEqual([id(track) for track in after],
+                             [id(before[2]), id(before[0]), id(before[1])])
+
+            # A new version of the playlist gets new Track objects
+            self.playlist_data["version"] = 2
+            await self.sisbot.push([dict(self.playlist_data)])
+            rebuilt = table.get_playlist_by_id("p1").tracks  # type: ignore
+            self.assertIsNot(table._playback_orders["p1"], order)
+            self.assertIsNot(rebuilt[0], after[0])
+            await table.close()
+
+        async def test_upcoming_tracks_wrap_when_looping(self) -> None:
+            table = await self.connect_three()
+            playlist = table.get_playlist_by_id("p1")
+            await playlist.play(playlist.tracks[1])  # type: ignore
+
+            playlist = table.get_playlist_by_id("p1")
+            self.assertEqual(
+                [track.id for track in playlist.upcoming_tracks(3)], ["t3"])  # type: ignore
+
+            self.playlist_data["is_loop"] = "true"
+            await self.sisbot.push([dict(self.playlist_data)])
+            playlist = table.get_playlist_by_id("p1")
+            self.assertEqual(
+                [track.id for track in playlist.upcoming_tracks(4)],  # type: ignore
+                ["t3", "t1", "t2", "t3"])
+            self.assertEqual(playlist.upcoming_tracks(0), [])  # type: ignore
+            await table.close()
+
+        async def test_prefetch_skips_cached_tracks(self) -> None:
+            table = await self.connect_three()
+            downloads = self.count_requests("get_track_verts")
+            table.enable_prefetch(count=1)
+            await table.get_playlist_by_id("p1").play()  # type: ignore
+            await asyncio.gather(*table._background_tasks)
+            self.assertEqual(downloads["total"], 1)
+            self.assertIsNotNone(table.duration_model.get_path_length("t2"))
+
+            # t2 is cached, so only t3 is downloaded
+            prefetched = table.prefetch_upcoming(2)
+            await asyncio.gather(*table._background_tasks)
+            self.assertEqual([track.id for track in prefetched], ["t2", "t3"])
+            self.assertEqual(downloads["total"], 2)
+
+            # The same active track doesn't prefetch again
+            await table.refresh()
+            self.assertEqual(len(table._background_tasks), 0)
+            await table.close()
+
+        async def test_health_recovery_reconnects(self) -> None:
+            from unittest.mock import PropertyMock, patch
+
+            from .health import HealthMonitor, HealthState
+
+            table = await self.connect()
+            ping_delay: Optional[float] = None
+
+            async def ping(timeout: float) -> None:
+                if ping_delay is None:
+                    raise Exception("Unreachable")
+                await asyncio.sleep(ping_delay)
+
+            monitor = HealthMonitor(
+                "loopback",
+                ping,
+                table._on_health_changed,
+                degraded_latency=0.01,
+                offline_after=0.05)
+            with patch.object(
+                    LoopbackTransport,
+                    "health",
+                    new_callable=PropertyMock,
+                    return_value=monitor):
+                # Socket disconnected, then the heartbeat fails too
+                await table._try_update_table_state(None)
+                self.assertEqual(await monitor.beat(), HealthState.DEGRADED)
+                self.assertFalse(table.is_connected)
+                await asyncio.sleep(0.06)
+                self.assertEqual(await monitor.beat(), HealthState.OFFLINE)
+                self.assertFalse(table.is_connected)
+
+                ping_delay = 0
+                self.assertEqual(await monitor.beat(), HealthState.HEALTHY)
+                self.assertTrue(table.is_connected)
+
+                # Slow but reachable counts as connected
+                await table._try_update_table_state(None)
+                ping_delay = 0.1
+                self.assertEqual(await monitor.beat(), HealthState.DEGRADED)
+                self.assertTrue(table.is_connected)
+            await table.close()
+
+    unittest.main()
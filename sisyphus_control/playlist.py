@@ -1,11 +1,15 @@
-from datetime import datetime
-from typing import Any, Dict, ForwardRef, List, Optional, Type
+from concurrent.futures import Executor
+from datetime import datetime, timedelta, timezone
+from types import TracebackType
+from typing import Any, Dict, ForwardRef, List, Optional, Tuple, Type
+
+import asyncio
 
 from . import table
 from .data import Model
 from .log import log_data_change
 from .track import Track
-from .transport import TableTransport
+from .transport import Transport
 from .sisbot_json import parse_bool
 
 
@@ -19,12 +23,20 @@ will be created for that playlist -- one for each table that has it loaded."""
     def __init__(
             self,
             table: 'table.Table',
-            transport: TableTransport,
+            transport: Transport,
             data: Model):
         self.parent = table
-        self._transport: TableTransport = transport
+        self._transport: Transport = transport
         self._data: Model = data
 
+    def __eq__(self, other: object) -> bool:
+        return (isinstance(other, Playlist)
+                and other.parent is self.parent
+                and other.id == self.id)
+
+    def __hash__(self) -> int:
+        return hash((id(self.parent), self.id))
+
     def __str__(self) -> str:
         return "{name} v{version} ({num_tracks} tracks)".format(
             name=self.name,
@@ -41,15 +53,31 @@ will be created for that playlist -- one for each table that has it loaded."""
 
     @ property
     def tracks(self) -> List[Track]:
-        return [
-            self._get_track_by_index(index)
-            for index in self._data["sorted_tracks"]]
+        """Tracks in play order"""
+        return list(self.playback_order.tracks)
 
     def get_tracks_named(self, name: str) -> List[Track]:
         return [track for track in self.tracks if track.name == name]
 
+    @ property
+    def playback_order(self) -> "PlaybackOrder":
+        """Cached on the table, and only rebuilt when the playlist's tracks
+or order change"""
+        orders = self.parent._playback_orders
+        order = orders.get(self.id)
+        if order is None or not order.update(self):
+            order = PlaybackOrder(self)
+            orders[self.id] = order
+        return order
+
+    def upcoming_tracks(self, count: int) -> List[Track]:
+        """The next count tracks the table will play after the active track,
+wrapping around if the playlist loops"""
+        return self.playback_order.upcoming(
+            self._data["active_track_index"], count, self.is_loop)
+
     def _get_track_by_index(self, index: int) -> Track:
-        return Track(self, self._transport, self._data["tracks"][index])
+        return self.playback_order.tracks_by_index[index]
 
     @ property
     def is_loop(self) -> bool:
@@ -67,8 +95,11 @@ will be created for that playlist -- one for each table that has it loaded."""
         if value == self.is_shuffle:
             return
 
-        await self._transport.post("set_shuffle",
-                                   {"value": str(value).lower()})
+        await self.parent._post_optimistic(  # type: ignore
+            self._data,
+            {"is_shuffle": str(value).lower()},
+            "set_shuffle",
+            {"value": str(value).lower()})
 
     @ property
     def description(self) -> str:
@@ -94,15 +125,257 @@ will be created for that playlist -- one for each table that has it loaded."""
         return self._get_track_by_index(index)
 
     async def play(self, track: Optional[Track] = None) -> None:
+        changes: Dict[str, Any] = {}
         if track:
             if track.parent != self:
                 raise ValueError("Track object is not part of this playlist")
 
-            self._data["active_track_index"] = track.index_in_playlist
-            self._data["active_track_id"] = track.id
-        await self._transport.post("set_playlist", self._data.data)
+            changes["active_track_index"] = track.index_in_playlist
+            changes["active_track_id"] = track.id
+        await self._transport.post("set_playlist", self._play_payload(changes))
+        await self._commit(changes)
         await self.parent.play()
 
+    def _play_payload(self, changes: Dict[str, Any]) -> Dict[str, Any]:
+        """The table already has this playlist's tracks, so only send what it
+needs to start playing it."""
+        payload = {key: self._data[key] for key in _PLAY_KEYS if key in self._data}
+        payload.update(changes)
+        return payload
+
+    async def estimate_total_duration(self, speed: Optional[float] = None) -> timedelta:
+        """Estimated time to play every track once at the given speed (by
+default the table's current speed). Tracks whose path length isn't cached yet
+are downloaded from the table first, a couple at a time."""
+        tracks = self.tracks
+        durations = await self._estimate_durations(tracks, speed)
+        return sum((durations[track.id] for track in tracks), timedelta())
+
+    async def estimate_track_etas(
+            self,
+            speed: Optional[float] = None) -> List[Tuple[Track, datetime]]:
+        """Estimated start times of the tracks that will play after the
+active track, in play order. Empty if this playlist is not playing."""
+        active_index = self._data["active_track_index"]
+        sorted_tracks: List[int] = self._data["sorted_tracks"]
+        if active_index < 0 or active_index not in sorted_tracks:
+            return []
+
+        upcoming = [
+            self._get_track_by_index(index)
+            for index in sorted_tracks[sorted_tracks.index(active_index) + 1:]]
+        durations = await self._estimate_durations(upcoming, speed)
+
+        table = self.parent
+        as_of = table.active_track_remaining_time_as_of
+        active_playlist = table.active_playlist
+        if (as_of is not None
+                and active_playlist is not None
+                and active_playlist.id == self.id):
+            eta = as_of + table.active_track_remaining_time
+        else:
+            active_track = self._get_track_by_index(active_index)
+            eta = datetime.now(timezone.utc) + (
+                await self._estimate_durations([active_track], speed))[active_track.id]
+
+        etas: List[Tuple[Track, datetime]] = []
+        for track in upcoming:
+            etas.append((track, eta))
+            eta += durations[track.id]
+        return etas
+
+    async def _estimate_durations(
+            self,
+            tracks: List[Track],
+            speed: Optional[float]) -> Dict[str, timedelta]:
+        unique_tracks = {track.id: track for track in tracks}
+        model = self.parent.duration_model
+        # Tracks whose path length is cached are estimated right away; the
+        # rest are downloaded a few at a time, not all at once
+        downloads = asyncio.Semaphore(_MAX_CONCURRENT_DOWNLOADS)
+
+        async def estimate(track: Track) -> timedelta:
+            if model.get_path_length(track.id) is None:
+                async with downloads:
+                    await track.get_path_length()
+            return await track.estimate_duration(speed)
+
+        durations = await asyncio.gather(
+            *[estimate(track) for track in unique_tracks.values()])
+        return dict(zip(unique_tracks.keys(), durations))
+
+    async def render_thumbnails(
+            self,
+            executor: Optional[Executor] = None) -> Dict[str, Dict[Track.ThumbnailSize, bytes]]:
+        """Renders thumbnails for every track in the playlist, keyed by track
+ID. Rendering is spread over executor, or over a temporary process pool if
+none is given. Requires numpy."""
+        tracks: Dict[str, Track] = {track.id: track for track in self.tracks}
+        if executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor() as pool:
+                return await self.render_thumbnails(pool)
+
+        thumbnails = await asyncio.gather(
+            *[track.render_thumbnails(executor) for track in tracks.values()])
+        return dict(zip(tracks.keys(), thumbnails))
+
+    def edit(self) -> "PlaylistEdit":
+        """Returns an object for batching edits to this playlist. Edits are
+sent to the table as a single request when apply() is called or when the
+edit is used as an async context manager and the block exits normally."""
+        return PlaylistEdit(self)
+
+    async def _commit(self, changes: Dict[str, Any]) -> None:
+        # Through the collection, so change listeners see it too
+        await self.parent._collection.add(  # type: ignore
+            Model(dict(changes, id=self.id)))
+
+
+class PlaybackOrder:
+    """The tracks of one version of a playlist, in play order. Track objects
+are created once per version of the playlist and reused."""
+
+    def __init__(self, playlist: Playlist):
+        self._version = playlist._data.get("version")
+        self._source_tracks: List[Dict[str, Any]] = playlist._data["tracks"]
+        self.tracks_by_index: List[Track] = [
+            Track(playlist, playlist._transport, data)
+            for data in self._source_tracks]
+        self._set_order(playlist._data["sorted_tracks"])
+
+    @property
+    def tracks(self) -> List[Track]:
+        return self._tracks
+
+    def update(self, playlist: Playlist) -> bool:
+        """Bring the order up to date with playlist's data. Returns False if
+the tracks themselves changed and the order must be rebuilt."""
+        if (playlist._data.get("version") != self._version
+                or playlist._data["tracks"] is not self._source_tracks):
+            return False
+        sorted_tracks = playlist._data["sorted_tracks"]
+        if sorted_tracks != self._sorted_tracks:
+            # Reshuffled: same Track objects, new order
+            self._set_order(sorted_tracks)
+        return True
+
+    def upcoming(self, active_index: int, count: int, loop: bool) -> List[Track]:
+        position = self._positions.get(active_index)
+        if position is None or count <= 0:
+            return []
+        upcoming = self._tracks[position + 1:position + 1 + count]
+        if loop:
+            while len(upcoming) < count and self._tracks:
+                upcoming += self._tracks[:count - len(upcoming)]
+        return upcoming
+
+    def _set_order(self, sorted_tracks: List[int]) -> None:
+        self._sorted_tracks = list(sorted_tracks)
+        self._tracks = [self.tracks_by_index[index] for index in sorted_tracks]
+        self._positions: Dict[int, int] = {
+            index: position for position, index in enumerate(sorted_tracks)}
+
+
+class PlaylistEdit:
+    """Edits to a playlist, sent as one request by apply(). Indices are
+positions in play order, as in Playlist.tracks. A shuffled playlist stays
+shuffled: the tracks keep their unshuffled order (added tracks go at the end
+of it) and the play order is exactly as edited."""
+
+    def __init__(self, playlist: Playlist):
+        self._playlist = playlist
+        tracks: List[Dict[str, Any]] = playlist._data["tracks"]
+        self._order: List[Dict[str, Any]] = [
+            tracks[index] for index in playlist._data["sorted_tracks"]]
+        self._applied = False
+
+    async def __aenter__(self) -> "PlaylistEdit":
+        return self
+
+    async def __aexit__(
+            self,
+            exc_type: Optional[Type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType]) -> bool:
+        if exc_type is None:
+            await self.apply()
+        return False
+
+    def add(self, track: Track, index: Optional[int] = None) -> None:
+        """Add a track, by default at the end. The track may come from the
+table or from any playlist."""
+        data = {key: value for key, value in track._data.items()
+                if key != "_index"}
+        if index is None:
+            self._order.append(data)
+        else:
+            self._order.insert(index, data)
+
+    def remove(self, track: Track) -> None:
+        self._order.pop(self._position_of(track))
+
+    def move(self, track: Track, index: int) -> None:
+        self._order.insert(index, self._order.pop(self._position_of(track)))
+
+    async def apply(self) -> None:
+        if self._applied:
+            raise Exception("PlaylistEdit has already been applied")
+        self._applied = True
+
+        old_tracks: List[Dict[str, Any]] = self._playlist._data["tracks"]
+        if self._playlist.is_shuffle:
+            kept = set(id(data) for data in self._order)
+            old = set(id(data) for data in old_tracks)
+            stored = ([data for data in old_tracks if id(data) in kept]
+                      + [data for data in self._order if id(data) not in old])
+        else:
+            stored = list(self._order)
+        stored_index = {id(data): index for index, data in enumerate(stored)}
+
+        active_index = self._playlist._data.get("active_track_index", -1)
+        if 0 <= active_index < len(old_tracks):
+            active_index = stored_index.get(id(old_tracks[active_index]), -1)
+
+        changes: Dict[str, Any] = {
+            "tracks": [
+                dict(data, _index=index) for index, data in enumerate(stored)],
+            "sorted_tracks": [stored_index[id(data)] for data in self._order],
+            "active_track_index": active_index,
+        }
+        payload = {
+            "id": self._playlist.id,
+            "type": "playlist",
+            "is_shuffle": self._playlist._data.get("is_shuffle"),
+        }
+        payload.update(changes)
+        await self._playlist._transport.post("add_playlist", payload)
+        await self._playlist._commit(changes)
+
+    def _position_of(self, track: Track) -> int:
+        if track.parent != self._playlist:
+            raise ValueError("Track object is not part of this playlist")
+
+        data = self._playlist._data["tracks"][track.index_in_playlist]
+        for position, entry in enumerate(self._order):
+            if entry is data:
+                return position
+
+        raise ValueError("Track has already been removed")
+
+
+_MAX_CONCURRENT_DOWNLOADS = 2
+
+_PLAY_KEYS = [
+    "id",
+    "type",
+    "active_track_index",
+    "active_track_id",
+    "is_shuffle",
+    "is_loop",
+]
+
 
 def _parse_date(date_str: str) -> datetime:
     return datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
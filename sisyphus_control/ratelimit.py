@@ -0,0 +1,295 @@
+from enum import Enum
+from typing import Dict, Optional, Tuple
+
+import asyncio
+import time
+
+from .scheduler import Priority
+
+
+class EndpointClass(Enum):
+    POLL = "poll"
+    COMMAND = "command"
+    # Large reads, such as track geometry, with their own budget so they
+    # never use up the one for user commands
+    BULK = "bulk"
+
+
+_POLL_ENDPOINTS = frozenset(["state", "get_track_time", "exists", "connect"])
+_BULK_ENDPOINTS = frozenset(["get_track_verts"])
+
+
+def classify_endpoint(endpoint: str) -> EndpointClass:
+    if endpoint in _POLL_ENDPOINTS:
+        return EndpointClass.POLL
+    if endpoint in _BULK_ENDPOINTS:
+        return EndpointClass.BULK
+    return EndpointClass.COMMAND
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to burst
+requests.
+
+Waiting requests are served in priority order: a BACKGROUND request doesn't
+take a token while an INTERACTIVE one is waiting, and leaves the last token
+of the burst (if burst is more than 1) for INTERACTIVE requests."""
+
+    def __init__(self, rate: float, burst: int):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._waiting: Dict[Priority, int] = {priority: 0 for priority in Priority}
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    @property
+    def burst(self) -> int:
+        return self._burst
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def try_acquire(self, priority: Priority = Priority.INTERACTIVE) -> bool:
+        if any(self._waiting[p] for p in Priority if p < priority):
+            return False
+        self._refill()
+        if self._tokens >= 1 + self._reserved_for(priority):
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, priority: Priority = Priority.INTERACTIVE) -> None:
+        if self.try_acquire(priority):
+            return
+
+        self._waiting[priority] += 1
+        try:
+            while not self.try_acquire(priority):
+                # At least a tenth of a token's time, in case the wait is for
+                # a higher priority request rather than for tokens
+                deficit = 1 + self._reserved_for(priority) - self._tokens
+                await asyncio.sleep(max(deficit, 0.1) / self._rate)
+        finally:
+            self._waiting[priority] -= 1
+
+    def _reserved_for(self, priority: Priority) -> int:
+        if priority == Priority.INTERACTIVE or self._burst == 1:
+            return 0
+        return 1
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            float(self._burst),
+            self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+
+class RateLimiter:
+    """Token buckets for each endpoint class of one table. Use
+get_rate_limiter to get the instance shared by everything talking to a given
+IP."""
+
+    DEFAULT_LIMITS: Dict[EndpointClass, Tuple[float, int]] = {
+        EndpointClass.POLL: (2.0, 4),
+        EndpointClass.COMMAND: (5.0, 10),
+        EndpointClass.BULK: (1.0, 4),
+    }
+
+    def __init__(self):
+        self._buckets: Dict[EndpointClass, TokenBucket] = {
+            endpoint_class: TokenBucket(rate, burst)
+            for endpoint_class, (rate, burst) in self.DEFAULT_LIMITS.items()}
+
+    def configure(
+            self,
+            endpoint_class: EndpointClass,
+            rate: float,
+            burst: int) -> None:
+        self._buckets[endpoint_class] = TokenBucket(rate, burst)
+
+    def get_bucket(self, endpoint_class: EndpointClass) -> TokenBucket:
+        return self._buckets[endpoint_class]
+
+    async def acquire(
+            self,
+            endpoint: str,
+            fail_fast: bool = False,
+            priority: Priority = Priority.INTERACTIVE) -> None:
+        """Wait until a request to endpoint is allowed. If fail_fast is True,
+raise RateLimitExceeded instead of waiting."""
+        bucket = self._buckets[classify_endpoint(endpoint)]
+        if fail_fast:
+            if not bucket.try_acquire(priority):
+                raise RateLimitExceeded(
+                    "Rate limit exceeded for {endpoint}".format(
+                        endpoint=endpoint))
+        else:
+            await bucket.acquire(priority)
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(ip: str) -> RateLimiter:
+    limiter: Optional[RateLimiter] = _rate_limiters.get(ip)
+    if limiter is None:
+        limiter = RateLimiter()
+        _rate_limiters[ip] = limiter
+    return limiter
+
+
+if __name__ == "__main__":
+    import aiounittest
+    import unittest
+    from typing import List
+    from unittest.mock import patch
+
+    class TokenBucketTests(unittest.TestCase):
+        @patch("time.monotonic")
+        def test_allows_burst_then_refills_at_rate(self, monotonic) -> None:
+            monotonic.return_value = 100.0
+            bucket = TokenBucket(rate=2.0, burst=3)
+            self.assertTrue(bucket.try_acquire())
+            self.assertTrue(bucket.try_acquire())
+            self.assertTrue(bucket.try_acquire())
+            self.assertFalse(bucket.try_acquire())
+
+            monotonic.return_value = 100.25
+            self.assertFalse(bucket.try_acquire())
+            monotonic.return_value = 100.5
+            self.assertTrue(bucket.try_acquire())
+            self.assertFalse(bucket.try_acquire())
+
+        @patch("time.monotonic")
+        def test_refill_is_capped_at_burst(self, monotonic) -> None:
+            monotonic.return_value = 100.0
+            bucket = TokenBucket(rate=2.0, burst=3)
+            while bucket.try_acquire():
+                pass
+
+            monotonic.return_value = 200.0
+            self.assertEqual(bucket.tokens, 3.0)
+
+        @patch("time.monotonic")
+        def test_background_leaves_a_token_for_interactive(self, monotonic) -> None:
+            monotonic.return_value = 100.0
+            bucket = TokenBucket(rate=2.0, burst=3)
+            self.assertTrue(bucket.try_acquire(Priority.BACKGROUND))
+            self.assertTrue(bucket.try_acquire(Priority.BACKGROUND))
+            self.assertFalse(bucket.try_acquire(Priority.BACKGROUND))
+            self.assertTrue(bucket.try_acquire(Priority.INTERACTIVE))
+
+    class TokenBucketPriorityTests(aiounittest.AsyncTestCase):
+        async def test_interactive_waiter_is_served_first(self) -> None:
+            bucket = TokenBucket(rate=20.0, burst=1)
+            self.assertTrue(bucket.try_acquire())
+            order: List[str] = []
+
+            async def acquire(name: str, priority: Priority) -> None:
+                await bucket.acquire(priority)
+                order.append(name)
+
+            background = asyncio.ensure_future(
+                acquire("background", Priority.BACKGROUND))
+            await asyncio.sleep(0)
+            interactive = asyncio.ensure_future(
+                acquire("interactive", Priority.INTERACTIVE))
+            await asyncio.wait_for(asyncio.gather(background, interactive), 1)
+            self.assertEqual(order, ["interactive", "background"])
+
+    class RateLimiterTests(aiounittest.AsyncTestCase):
+        async def test_fail_fast_raises(self) -> None:
+            limiter = RateLimiter()
+            limiter.configure(EndpointClass.COMMAND, rate=0.001, burst=1)
+            await limiter.acquire("set_speed", fail_fast=True)
+            with self.assertRaises(RateLimitExceeded):
+                await limiter.acquire("set_speed", fail_fast=True)
+
+        async def test_poll_and_command_buckets_are_separate(self) -> None:
+            limiter = RateLimiter()
+            limiter.configure(EndpointClass.COMMAND, rate=0.001, burst=1)
+            limiter.configure(EndpointClass.POLL, rate=0.001, burst=1)
+            await limiter.acquire("state", fail_fast=True)
+            await limiter.acquire("set_speed", fail_fast=True)
+            with self.assertRaises(RateLimitExceeded):
+                await limiter.acquire("state", fail_fast=True)
+
+        async def test_bulk_reads_do_not_use_command_tokens(self) -> None:
+            limiter = RateLimiter()
+            limiter.configure(EndpointClass.COMMAND, rate=0.001, burst=1)
+            limiter.configure(EndpointClass.BULK, rate=0.001, burst=2)
+            self.assertEqual(classify_endpoint("get_track_verts"), EndpointClass.BULK)
+            await limiter.acquire("get_track_verts", fail_fast=True)
+            await limiter.acquire("get_track_verts", fail_fast=True)
+            with self.assertRaises(RateLimitExceeded):
+                await limiter.acquire("get_track_verts", fail_fast=True)
+            await limiter.acquire("pause", fail_fast=True)
+
+        async def test_transport_fail_fast_raises(self) -> None:
+            # This file runs as __main__, so use the package's copy of the
+            # module, which is the one the transport uses
+            from . import ratelimit
+            from .transport import TableTransport
+
+            ratelimit.get_rate_limiter("fail-fast-test").configure(
+                ratelimit.EndpointClass.COMMAND, rate=0.001, burst=1)
+            transport = TableTransport("fail-fast-test", fail_fast=True)
+            sent = []
+
+            async def fake_post(endpoint, data, timeout):
+                sent.append(endpoint)
+                return []
+
+            transport.start = lambda: None  # type: ignore
+            transport._post = fake_post  # type: ignore
+            await transport.post("set_speed", {"value": 0.5})
+            with self.assertRaises(ratelimit.RateLimitExceeded):
+                await transport.post("set_speed", {"value": 0.6})
+            self.assertEqual(sent, ["set_speed"])
+
+        async def test_background_downloads_do_not_delay_commands(self) -> None:
+            from . import scheduler
+            from .transport import TableTransport
+
+            transport = TableTransport("download-test", fail_fast=True)
+            downloads_done = asyncio.Event()
+
+            async def fake_post(endpoint, data, timeout):
+                if endpoint == "get_track_verts":
+                    await downloads_done.wait()
+                return []
+
+            transport.start = lambda: None  # type: ignore
+            transport._post = fake_post  # type: ignore
+            downloads = [
+                asyncio.ensure_future(transport.post(
+                    "get_track_verts",
+                    {"id": str(i)},
+                    priority=scheduler.Priority.BACKGROUND,
+                    fail_fast=False))
+                for i in range(100)]
+            await asyncio.sleep(0)
+
+            await asyncio.wait_for(transport.post("pause"), 0.5)
+
+            downloads_done.set()
+            for download in downloads:
+                download.cancel()
+            await asyncio.gather(*downloads, return_exceptions=True)
+
+    unittest.main()
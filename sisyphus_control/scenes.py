@@ -0,0 +1,406 @@
+r"""
+An in-process scheduler for timed table actions (wake, sleep, play a
+playlist, brightness and speed ramps) across any number of connected tables.
+
+All jobs share one heap of due times and a single timer task, rather than a
+sleeping task per job. Recurring jobs are described by rules; if a state file
+is given, the time each job last ran is saved there so that jobs missed while
+the process wasn't running are caught up (once) when it restarts.
+"""
+
+from abc import ABC, abstractmethod
+from datetime import datetime, time, timedelta, tzinfo
+from typing import (Any, Awaitable, Callable, Dict, Iterable, List, Optional,
+                    Tuple)
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import math
+
+from .table import Table
+
+_LOGGER = logging.getLogger("sisyphus-control")
+
+Action = Callable[[], Awaitable[Any]]
+
+
+def local_now() -> datetime:
+    return datetime.now().astimezone()
+
+
+class Rule(ABC):
+    @abstractmethod
+    def next_after(self, after: datetime) -> Optional[datetime]:
+        """The first time strictly after after that the job should run, or
+None if it should not run again"""
+        ...
+
+
+class Once(Rule):
+    def __init__(self, at: datetime):
+        self._at = at
+
+    def next_after(self, after: datetime) -> Optional[datetime]:
+        return self._at if self._at > after else None
+
+
+class Every(Rule):
+    """Runs every interval, aligned to start"""
+
+    def __init__(self, interval: timedelta, start: Optional[datetime] = None):
+        if interval <= timedelta():
+            raise ValueError("interval must be positive")
+        self._interval = interval
+        self._start = start
+
+    def next_after(self, after: datetime) -> Optional[datetime]:
+        start = self._start or after
+        if start > after:
+            return start
+        periods = math.floor((after - start) / self._interval) + 1
+        return start + periods * self._interval
+
+
+class Daily(Rule):
+    """Runs at a time of day, optionally only on some weekdays (0 is
+Monday). The time is wall-clock time in tz, or in the system's local time zone
+if tz is None, so it stays put across daylight saving changes. (With naive
+datetimes, it is simply compared with them.)"""
+
+    def __init__(
+            self,
+            at: time,
+            weekdays: Optional[Iterable[int]] = None,
+            tz: Optional[tzinfo] = None):
+        self._at = at
+        self._weekdays = frozenset(weekdays) if weekdays is not None else None
+        self._tz = tz
+
+    def next_after(self, after: datetime) -> Optional[datetime]:
+        # Work in naive wall-clock time and localize each candidate, since
+        # adding a day to an aware datetime keeps its (possibly stale) offset
+        if after.tzinfo is None:
+            wall_after = after
+        elif self._tz is None:
+            wall_after = after.astimezone().replace(tzinfo=None)
+        else:
+            wall_after = after.astimezone(self._tz).replace(tzinfo=None)
+
+        candidate = wall_after.replace(
+            hour=self._at.hour,
+            minute=self._at.minute,
+            second=self._at.second,
+            microsecond=self._at.microsecond)
+        if candidate <= wall_after:
+            candidate += timedelta(days=1)
+        for _ in range(8):
+            if self._weekdays is None or candidate.weekday() in self._weekdays:
+                localized = self._localize(candidate, after)
+                if localized > after:
+                    return localized
+            candidate += timedelta(days=1)
+        return None
+
+    def _localize(self, wall: datetime, like: datetime) -> datetime:
+        if like.tzinfo is None:
+            return wall
+        if self._tz is None:
+            return wall.astimezone()
+        return wall.replace(tzinfo=self._tz)
+
+
+class Job:
+    def __init__(self, name: str, rule: Rule, action: Action):
+        self.name = name
+        self.rule = rule
+        self.action = action
+        self.next_run: Optional[datetime] = None
+        self.last_run: Optional[datetime] = None
+        # Pending one-off steps started by this job (ramps)
+        self.steps: List["Job"] = []
+
+    def cancel_steps(self) -> None:
+        for step in self.steps:
+            # Heap entries for the step are skipped when they come due
+            step.next_run = None
+        self.steps = []
+
+
+class SceneScheduler:
+    def __init__(
+            self,
+            state_path: Optional[str] = None,
+            misfire_grace: timedelta = timedelta(hours=1),
+            now: Callable[[], datetime] = local_now):
+        self._state_path = state_path
+        self._misfire_grace = misfire_grace
+        self._now = now
+        self._jobs: Dict[str, Job] = {}
+        self._heap: List[Tuple[datetime, int, Job]] = []
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._timer: Optional["asyncio.Task[None]"] = None
+        self._ramps: Dict[Tuple[int, str], Job] = {}
+
+    async def __aenter__(self) -> "SceneScheduler":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args: Any) -> bool:
+        await self.stop()
+        return False
+
+    @property
+    def jobs(self) -> List[Job]:
+        return list(self._jobs.values())
+
+    def add_job(self, name: str, rule: Rule, action: Action) -> Job:
+        """Schedule action according to rule. Names identify jobs in the state
+file, so they must be unique and stable across restarts."""
+        if name in self._jobs:
+            raise ValueError("A job named {name} already exists".format(name=name))
+        job = Job(name, rule, action)
+        self._jobs[name] = job
+        if self._timer is not None:
+            self._schedule(job, self._now())
+        return job
+
+    def remove_job(self, name: str) -> None:
+        # Heap entries for the job are skipped when they come due
+        job = self._jobs.pop(name)
+        job.next_run = None
+        job.cancel_steps()
+
+    def add_ramp(
+            self,
+            name: str,
+            rule: Rule,
+            table: Table,
+            attribute: str,
+            target: float,
+            duration: timedelta,
+            resolution: float = 0.01,
+            min_interval: timedelta = timedelta(seconds=1)) -> Job:
+        """Each time rule fires, move the table's brightness or speed from its
+current value to target over duration. Steps are at least resolution apart
+in value and min_interval apart in time, so a ramp sends at most
+|target - current| / resolution commands, and none if the table is already
+at target. Starting a ramp cancels the remaining steps of any earlier ramp of
+the same attribute of the same table, and removing the job cancels its
+remaining steps."""
+        if attribute not in ("brightness", "speed"):
+            raise ValueError("Can only ramp brightness or speed")
+        setter = getattr(table, "set_" + attribute)
+        ramp_key = (id(table), attribute)
+
+        async def start_ramp() -> None:
+            previous = self._ramps.get(ramp_key)
+            if previous is not None:
+                previous.cancel_steps()
+            self._ramps[ramp_key] = job
+
+            start_value = getattr(table, attribute)
+            steps = min(
+                math.floor(abs(target - start_value) / resolution),
+                math.floor(duration / min_interval))
+            if steps <= 0:
+                if start_value != target:
+                    await setter(target)
+                return
+
+            start_time = self._now()
+            for step in range(1, steps + 1):
+                value = round(start_value + (target - start_value) * step / steps, 6)
+                due = start_time + duration * step / steps
+                step_job = Job(
+                    "{name} step {step}".format(name=name, step=step),
+                    Once(due),
+                    lambda value=value: setter(value))
+                job.steps.append(step_job)
+                self._push(due, step_job)
+
+        job = self.add_job(name, rule, start_ramp)
+        return job
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        now = self._now()
+        last_runs = self._load_state()
+        for job in self._jobs.values():
+            last_run = last_runs.get(job.name)
+            job.last_run = last_run
+            if last_run is not None:
+                missed = job.rule.next_after(last_run)
+                if missed is not None and missed <= now:
+                    if now - missed <= self._misfire_grace:
+                        _LOGGER.info("Catching up on missed job %s", job.name)
+                        self._push(now, job)
+                        continue
+                    _LOGGER.info("Skipping job %s missed at %s", job.name, missed)
+            self._schedule(job, now)
+
+        self._timer = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            try:
+                await self._timer
+            except asyncio.CancelledError:
+                pass
+            self._timer = None
+
+    def _schedule(self, job: Job, after: datetime) -> None:
+        next_run = job.rule.next_after(after)
+        if next_run is not None:
+            self._push(next_run, job)
+
+    def _push(self, due: datetime, job: Job) -> None:
+        job.next_run = due
+        heapq.heappush(self._heap, (due, next(self._sequence), job))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        assert self._wakeup is not None
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = (self._heap[0][0] - self._now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due, _, job = heapq.heappop(self._heap)
+            if job.next_run != due:
+                # Removed or rescheduled since this entry was pushed
+                continue
+            job.next_run = None
+            asyncio.ensure_future(self._run_job(job))
+            if job.name in self._jobs:
+                self._schedule(job, max(due, self._now()))
+
+    async def _run_job(self, job: Job) -> None:
+        try:
+            await job.action()
+        except Exception:
+            _LOGGER.exception("Scheduled job %s failed", job.name)
+        if job.name in self._jobs:
+            job.last_run = self._now()
+            self._save_state()
+
+    def _load_state(self) -> Dict[str, datetime]:
+        if self._state_path is None:
+            return {}
+        try:
+            with open(self._state_path, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        return {
+            name: datetime.fromisoformat(last_run)
+            for name, last_run in state.get("last_runs", {}).items()}
+
+    def _save_state(self) -> None:
+        if self._state_path is None:
+            return
+        with open(self._state_path, "w") as f:
+            json.dump({
+                "last_runs": {
+                    job.name: job.last_run.isoformat()
+                    for job in self._jobs.values() if job.last_run is not None}
+            }, f)
+
+
+if __name__ == "__main__":
+    import aiounittest
+    import os
+    import time as time_module
+    import unittest
+
+    class FakeTable:
+        def __init__(self):
+            self.brightness = 0.0
+            self.values: List[float] = []
+
+        async def set_brightness(self, value: float) -> None:
+            self.brightness = value
+            self.values.append(value)
+
+    class DailyTests(unittest.TestCase):
+        def setUp(self) -> None:
+            self._tz = os.environ.get("TZ")
+            os.environ["TZ"] = "Europe/Berlin"
+            time_module.tzset()
+
+        def tearDown(self) -> None:
+            if self._tz is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = self._tz
+            time_module.tzset()
+
+        def test_keeps_local_time_across_dst_change(self) -> None:
+            rule = Daily(time(7, 0))
+            # The day before clocks go back, with its summer-time offset
+            after = datetime(2026, 10, 24, 8, 0).astimezone()
+            next_run = rule.next_after(after)
+            assert next_run is not None
+            self.assertEqual(next_run.astimezone().replace(tzinfo=None),
+                             datetime(2026, 10, 25, 7, 0))
+            self.assertEqual(next_run.utcoffset(), timedelta(hours=1))
+
+        def test_weekdays(self) -> None:
+            rule = Daily(time(7, 0), weekdays=[0])
+            next_run = rule.next_after(datetime(2026, 10, 21, 12, 0))
+            self.assertEqual(next_run, datetime(2026, 10, 26, 7, 0))
+
+    class RampTests(aiounittest.AsyncTestCase):
+        async def test_remove_job_cancels_steps(self) -> None:
+            table = FakeTable()
+            scheduler = SceneScheduler()
+            job = scheduler.add_ramp(
+                "ramp", Once(local_now() + timedelta(days=1)), table,  # type: ignore
+                "brightness", 1.0, timedelta(seconds=0.2),
+                resolution=0.1, min_interval=timedelta(seconds=0.01))
+            async with scheduler:
+                await job.action()
+                scheduler.remove_job("ramp")
+                await asyncio.sleep(0.3)
+            self.assertEqual(table.values, [])
+
+        async def test_new_ramp_replaces_running_ramp(self) -> None:
+            table = FakeTable()
+            scheduler = SceneScheduler()
+            later = Once(local_now() + timedelta(days=1))
+            up = scheduler.add_ramp(
+                "up", later, table, "brightness", 1.0,  # type: ignore
+                timedelta(seconds=0.2), resolution=0.1,
+                min_interval=timedelta(seconds=0.01))
+            down = scheduler.add_ramp(
+                "down", later, table, "brightness", 0.0,  # type: ignore
+                timedelta(seconds=0.1), resolution=0.1,
+                min_interval=timedelta(seconds=0.01))
+            async with scheduler:
+                await up.action()
+                await asyncio.sleep(0.05)
+                await down.action()
+                await asyncio.sleep(0.3)
+            # No step of the first ramp runs after the second one starts, so
+            # brightness rises and then only falls
+            self.assertEqual(table.brightness, 0.0)
+            peak = table.values.index(max(table.values))
+            self.assertGreater(peak, 0)
+            self.assertEqual(
+                table.values[peak:], sorted(table.values[peak:], reverse=True))
+
+    unittest.main()
@@ -0,0 +1,270 @@
+from collections import deque
+from enum import IntEnum
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+import asyncio
+import time
+
+T = TypeVar("T")
+
+
+class Priority(IntEnum):
+    """Lower values are run first."""
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class CommandScheduler:
+    """Runs commands against one table, at most max_concurrency at a time.
+
+Waiting commands are started in priority order, FIFO within a priority. A
+lower-priority command that has waited longer than starvation_timeout seconds
+is started ahead of higher-priority ones so background work always makes
+progress.
+
+Up to reserved_interactive slots beyond max_concurrency can only be used by
+INTERACTIVE commands while lower-priority ones hold the others, so a command
+never waits behind a long background transfer such as a geometry download.
+INTERACTIVE commands alone still run at most max_concurrency at a time."""
+
+    def __init__(
+            self,
+            max_concurrency: int = 1,
+            starvation_timeout: float = 5.0,
+            reserved_interactive: int = 1):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if reserved_interactive < 0:
+            raise ValueError("reserved_interactive must not be negative")
+        self._max_concurrency = max_concurrency
+        self._reserved_interactive = reserved_interactive
+        self._starvation_timeout = starvation_timeout
+        self._active: Dict[Priority, int] = {priority: 0 for priority in Priority}
+        self._waiters: Dict[Priority, Deque[Tuple[float, "asyncio.Future[None]"]]] = {
+            priority: deque() for priority in Priority}
+        self._max_queue_depth = 0
+        self._promoted_count = 0
+
+    @property
+    def active_count(self) -> int:
+        return sum(self._active.values())
+
+    @property
+    def queue_depths(self) -> Dict[Priority, int]:
+        return {
+            priority: len(waiters)
+            for priority, waiters in self._waiters.items()}
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    @property
+    def max_queue_depth(self) -> int:
+        """Largest total queue depth seen since creation"""
+        return self._max_queue_depth
+
+    @property
+    def promoted_count(self) -> int:
+        """Number of commands started early by starvation protection"""
+        return self._promoted_count
+
+    async def run(
+            self,
+            func: Callable[[], Awaitable[T]],
+            priority: Priority = Priority.INTERACTIVE) -> T:
+        await self._acquire(priority)
+        try:
+            return await func()
+        finally:
+            self._release(priority)
+
+    async def _acquire(self, priority: Priority) -> None:
+        if self._can_start(priority) and not any(
+                self._waiters[p] for p in Priority if p <= priority):
+            self._active[priority] += 1
+            return
+
+        waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        entry = (time.monotonic(), waiter)
+        self._waiters[priority].append(entry)
+        self._max_queue_depth = max(self._max_queue_depth, self.queue_depth)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # We were granted a slot just as we were cancelled; pass it on
+                self._release(priority)
+            else:
+                self._waiters[priority].remove(entry)
+            raise
+
+    def _release(self, priority: Priority) -> None:
+        self._active[priority] -= 1
+        self._start_waiters()
+
+    def _can_start(self, priority: Priority) -> bool:
+        active = self.active_count
+        if priority == Priority.INTERACTIVE:
+            return (self._active[priority] < self._max_concurrency
+                    and active < self._max_concurrency + self._reserved_interactive)
+        return active < self._max_concurrency
+
+    def _start_waiters(self) -> None:
+        while True:
+            next_waiter = self._next_waiter()
+            if next_waiter is None:
+                return
+            priority, waiter = next_waiter
+            if waiter.done():
+                continue
+            self._active[priority] += 1
+            waiter.set_result(None)
+
+    def _next_waiter(self) -> "Optional[Tuple[Priority, asyncio.Future[None]]]":
+        startable = [
+            priority for priority, waiters in self._waiters.items()
+            if waiters and self._can_start(priority)]
+        if not startable:
+            return None
+
+        now = time.monotonic()
+        starved: List[Priority] = [
+            priority for priority in startable
+            if now - self._waiters[priority][0][0] >= self._starvation_timeout]
+        if starved:
+            # Oldest starved command goes first, regardless of priority
+            priority = min(starved, key=lambda p: self._waiters[p][0][0])
+            if priority != min(p for p, w in self._waiters.items() if w):
+                self._promoted_count += 1
+        else:
+            priority = min(startable)
+        return priority, self._waiters[priority].popleft()[1]
+
+
+if __name__ == "__main__":
+    import aiounittest
+    import unittest
+
+    class CommandSchedulerTests(aiounittest.AsyncTestCase):
+        async def test_interactive_runs_ahead_of_background(self) -> None:
+            scheduler = CommandScheduler()
+            order: List[str] = []
+            gate = asyncio.Event()
+
+            async def hold() -> None:
+                await gate.wait()
+
+            async def record(name: str) -> None:
+                order.append(name)
+
+            holder = asyncio.ensure_future(scheduler.run(hold))
+            await asyncio.sleep(0)
+            background = asyncio.ensure_future(
+                scheduler.run(lambda: record("background"), Priority.BACKGROUND))
+            interactive = asyncio.ensure_future(
+                scheduler.run(lambda: record("interactive"), Priority.INTERACTIVE))
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.queue_depth, 2)
+
+            gate.set()
+            await asyncio.gather(holder, background, interactive)
+            self.assertEqual(order, ["interactive", "background"])
+            self.assertEqual(scheduler.promoted_count, 0)
+
+        async def test_starved_background_is_promoted(self) -> None:
+            scheduler = CommandScheduler(starvation_timeout=0.05)
+            order: List[str] = []
+            gate = asyncio.Event()
+
+            async def hold() -> None:
+                await gate.wait()
+
+            async def record(name: str) -> None:
+                order.append(name)
+
+            holder = asyncio.ensure_future(scheduler.run(hold))
+            await asyncio.sleep(0)
+            background = asyncio.ensure_future(
+                scheduler.run(lambda: record("background"), Priority.BACKGROUND))
+            await asyncio.sleep(0.1)
+            interactive = asyncio.ensure_future(
+                scheduler.run(lambda: record("interactive"), Priority.INTERACTIVE))
+            await asyncio.sleep(0)
+
+            gate.set()
+            await asyncio.gather(holder, background, interactive)
+            self.assertEqual(order, ["background", "interactive"])
+            self.assertEqual(scheduler.promoted_count, 1)
+
+        async def test_interactive_does_not_wait_for_background(self) -> None:
+            scheduler = CommandScheduler()
+            gate = asyncio.Event()
+
+            async def hold() -> None:
+                await gate.wait()
+
+            async def noop() -> None:
+                pass
+
+            download = asyncio.ensure_future(scheduler.run(hold, Priority.BACKGROUND))
+            await asyncio.sleep(0)
+            # The reserved slot: no waiting for the download to finish
+            await asyncio.wait_for(scheduler.run(noop), 1)
+
+            # but background work and interactive commands are each still
+            # limited to max_concurrency
+            command = asyncio.ensure_future(scheduler.run(hold))
+            await asyncio.sleep(0)
+            queued = [
+                asyncio.ensure_future(scheduler.run(noop)),
+                asyncio.ensure_future(scheduler.run(noop, Priority.BACKGROUND))]
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.active_count, 2)
+            self.assertEqual(scheduler.queue_depth, 2)
+
+            gate.set()
+            await asyncio.gather(download, command, *queued)
+            self.assertEqual(scheduler.active_count, 0)
+
+        async def test_cancelled_waiter_does_not_leak_slot(self) -> None:
+            scheduler = CommandScheduler()
+
+            async def noop() -> None:
+                pass
+
+            await scheduler._acquire(Priority.INTERACTIVE)
+            waiter = asyncio.ensure_future(scheduler.run(noop))
+            await asyncio.sleep(0)
+
+            # Hand the slot to the waiter and cancel it before it can run
+            scheduler._release(Priority.INTERACTIVE)
+            self.assertEqual(scheduler.active_count, 1)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+
+            self.assertEqual(scheduler.active_count, 0)
+            await asyncio.wait_for(scheduler.run(noop), 1)
+
+        async def test_cancelled_queued_waiter_is_removed(self) -> None:
+            scheduler = CommandScheduler()
+            gate = asyncio.Event()
+
+            async def hold() -> None:
+                await gate.wait()
+
+            holder = asyncio.ensure_future(scheduler.run(hold))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(scheduler.run(hold))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+
+            self.assertEqual(scheduler.queue_depth, 0)
+            gate.set()
+            await holder
+            self.assertEqual(scheduler.active_count, 0)
+
+    unittest.main()
@@ -0,0 +1,424 @@
+r"""
+Runs a large fleet of tables across several worker processes, so that JSON
+parsing, state merging and listener fan-out for different tables use
+different CPU cores.
+
+Each worker process owns the Table connections for a subset of the IPs and
+sends compact deltas (only the keys that changed) to the coordinating
+process. The coordinator keeps a merged, read-only view of every table's
+state and routes commands to the worker that owns the table.
+
+Workers are started with the ``spawn`` method, so scripts using ShardedFleet
+must guard their entry point with ``if __name__ == "__main__":``. If a worker
+dies, start() and pending calls to its tables fail rather than waiting
+forever, and its tables are reported in errors.
+"""
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+
+from .data import Snapshot, snapshot_collection
+from .eventloop import run
+from .listeners import ListenerRegistry, Subscription
+
+_LOGGER = logging.getLogger("sisyphus-control")
+
+FleetListener = Union[Callable[[str], None], Callable[[str], Awaitable[None]]]
+
+# Table methods that may be called through ShardedFleet.call
+COMMANDS = frozenset([
+    "play",
+    "pause",
+    "sleep",
+    "wakeup",
+    "set_speed",
+    "set_brightness",
+    "set_shuffle",
+    "set_loop",
+    "refresh",
+])
+
+
+class ShardedFleet:
+    def __init__(
+            self,
+            ips: List[str],
+            num_shards: Optional[int] = None,
+            watch_interval: float = 0.5):
+        if num_shards is None:
+            num_shards = os.cpu_count() or 1
+        self._num_shards = max(1, min(num_shards, len(ips)))
+        self._shard_by_ip: Dict[str, int] = {
+            ip: index % self._num_shards for index, ip in enumerate(ips)}
+        self._state: Dict[str, Snapshot] = {}
+        self._errors: Dict[str, str] = {}
+        self._listeners: ListenerRegistry = ListenerRegistry()
+        self._pending: Dict[int, Tuple[int, "asyncio.Future[Any]"]] = {}
+        self._request_ids = itertools.count()
+        self._processes: List[Any] = []
+        self._command_queues: List[Any] = []
+        self._event_queue: Any = None
+        self._reader: Optional["asyncio.Task[None]"] = None
+        self._ready: Optional["asyncio.Future[None]"] = None
+        self._ready_count = 0
+        self._watch_interval = watch_interval
+        self._watcher: Optional["asyncio.Task[None]"] = None
+        self._dead_shards: Dict[int, str] = {}
+        self._stopping = False
+
+    async def __aenter__(self) -> "ShardedFleet":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args: Any) -> bool:
+        await self.stop()
+        return False
+
+    @property
+    def ips(self) -> List[str]:
+        return list(self._shard_by_ip.keys())
+
+    @property
+    def num_shards(self) -> int:
+        return self._num_shards
+
+    @property
+    def errors(self) -> Dict[str, str]:
+        """Connection errors for tables that could not be connected, by IP"""
+        return dict(self._errors)
+
+    def get_state(self, ip: str) -> Snapshot:
+        """Every model reported by the table at ip, keyed by model ID. Treat as
+read-only."""
+        return self._state.get(ip, {})
+
+    def get_table_data(self, ip: str) -> Optional[Dict[str, Any]]:
+        """The table's own (sisbot) model"""
+        for model in self.get_state(ip).values():
+            if model.get("type") == "sisbot":
+                return model
+        return None
+
+    def add_listener(self, listener: FleetListener, weak: bool = False) -> Subscription:
+        """listener is called with the IP of a table whenever its state
+changes"""
+        return self._listeners.add(listener, weak)
+
+    def remove_listener(self, listener: FleetListener) -> None:
+        self._listeners.remove(listener)
+
+    async def start(self) -> None:
+        """Start the workers and wait until each has tried to connect to its
+tables"""
+        loop = asyncio.get_running_loop()
+        # fork is unsafe with a running event loop and its threads
+        context = multiprocessing.get_context("spawn")
+        self._event_queue = context.Queue()
+        self._ready = loop.create_future()
+        for shard in range(self._num_shards):
+            ips = [ip for ip, s in self._shard_by_ip.items() if s == shard]
+            command_queue = context.Queue()
+            process = context.Process(
+                target=_run_shard,
+                args=(ips, command_queue, self._event_queue),
+                name="sisyphus-control-shard-{shard}".format(shard=shard),
+                daemon=True)
+            process.start()
+            self._command_queues.append(command_queue)
+            self._processes.append(process)
+
+        self._reader = asyncio.ensure_future(self._read_events())
+        self._watcher = asyncio.ensure_future(self._watch_processes())
+        await self._ready
+
+    async def stop(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._stopping = True
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+        for command_queue in self._command_queues:
+            command_queue.put(("stop",))
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join)
+        if self._reader is not None:
+            self._event_queue.put(("closed",))
+            await self._reader
+            self._reader = None
+        for _, future in self._pending.values():
+            if not future.done():
+                future.set_exception(Exception("ShardedFleet stopped"))
+        self._pending.clear()
+        self._processes = []
+        self._command_queues = []
+
+    async def call(self, ip: str, command: str, *args: Any) -> Any:
+        """Call a Table command method (see COMMANDS) on the table at ip, in
+the worker that owns it"""
+        if command not in COMMANDS:
+            raise ValueError("Unsupported command {command}".format(command=command))
+        shard = self._shard_by_ip.get(ip)
+        if shard is None:
+            raise ValueError("No table at {ip} in this fleet".format(ip=ip))
+        if shard in self._dead_shards:
+            raise Exception(self._dead_shards[shard])
+
+        request_id = next(self._request_ids)
+        future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (shard, future)
+        self._command_queues[shard].put(("call", request_id, ip, command, args))
+        return await future
+
+    async def _read_events(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            message: Tuple[Any, ...] = await loop.run_in_executor(
+                None, self._event_queue.get)
+            kind = message[0]
+            if kind == "closed":
+                return
+            elif kind == "ready":
+                self._ready_count += 1
+                if self._ready_count == self._num_shards and self._ready:
+                    self._ready.set_result(None)
+            elif kind == "snapshot":
+                _, ip, snapshot = message
+                self._state[ip] = snapshot
+                await self._notify_listeners(ip)
+            elif kind == "delta":
+                _, ip, changes = message
+                state = self._state.setdefault(ip, {})
+                for model_id, changed in changes.items():
+                    state.setdefault(model_id, {}).update(changed)
+                await self._notify_listeners(ip)
+            elif kind == "error":
+                _, ip, error = message
+                self._errors[ip] = error
+            elif kind == "result":
+                _, request_id, error, result = message
+                _, future = self._pending.pop(request_id, (None, None))
+                if future is None or future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(Exception(error))
+                else:
+                    future.set_result(result)
+
+    async def _notify_listeners(self, ip: str) -> None:
+        await self._listeners.notify(ip)
+
+    async def _watch_processes(self) -> None:
+        while True:
+            await asyncio.sleep(self._watch_interval)
+            for shard, process in enumerate(self._processes):
+                if shard not in self._dead_shards and not process.is_alive():
+                    self._on_shard_died(shard, process.exitcode)
+
+    def _on_shard_died(self, shard: int, exitcode: Optional[int]) -> None:
+        if self._stopping:
+            return
+        error = "Shard {shard} exited unexpectedly (exit code {exitcode})".format(
+            shard=shard, exitcode=exitcode)
+        _LOGGER.error(error)
+        self._dead_shards[shard] = error
+        for ip, s in self._shard_by_ip.items():
+            if s == shard:
+                self._errors.setdefault(ip, error)
+
+        if self._ready is not None and not self._ready.done():
+            self._ready.set_exception(Exception(error))
+        for request_id, (s, future) in list(self._pending.items()):
+            if s == shard:
+                del self._pending[request_id]
+                if not future.done():
+                    future.set_exception(Exception(error))
+
+
+def _run_shard(ips: List[str], command_queue: Any, event_queue: Any) -> None:
+    run(_shard_main(ips, command_queue, event_queue))
+
+
+async def _shard_main(ips: List[str], command_queue: Any, event_queue: Any) -> None:
+    from .table import Table
+
+    loop = asyncio.get_running_loop()
+    tables: Dict[str, Table] = {}
+
+    async def connect(ip: str) -> None:
+        try:
+            table = await Table.connect(ip)
+        except Exception as e:
+            _LOGGER.warning("Shard could not connect to %s: %s", ip, e)
+            event_queue.put(("error", ip, str(e)))
+            return
+
+        tables[ip] = table
+        event_queue.put(("snapshot", ip, snapshot_collection(table._collection)))
+
+        # Changed keys are collected as each model is updated and sent as one
+        # delta when the table notifies its listeners
+        changes: Snapshot = {}
+
+        def on_model_changed(model_id: Any, changed: Dict[str, Any]) -> None:
+            changes.setdefault(str(model_id), {}).update(changed)
+
+        def on_change() -> None:
+            if changes:
+                event_queue.put(("delta", ip, dict(changes)))
+                changes.clear()
+
+        table._collection.add_change_listener(on_model_changed)
+        table.add_listener(on_change)
+
+    await asyncio.gather(*[connect(ip) for ip in ips])
+    event_queue.put(("ready",))
+
+    while True:
+        message = await loop.run_in_executor(None, command_queue.get)
+        if message[0] == "stop":
+            break
+        _, request_id, ip, command, args = message
+        asyncio.ensure_future(
+            _run_command(tables.get(ip), request_id, command, args, event_queue))
+
+    await asyncio.gather(
+        *[table.close() for table in tables.values()],
+        return_exceptions=True)
+
+
+async def _run_command(
+        table: Any,
+        request_id: int,
+        command: str,
+        args: Tuple[Any, ...],
+        event_queue: Any) -> None:
+    if table is None:
+        event_queue.put(("result", request_id, "Table is not connected", None))
+        return
+    try:
+        result = await getattr(table, command)(*args)
+    except Exception as e:
+        event_queue.put(("result", request_id, str(e), None))
+        return
+    event_queue.put(("result", request_id, None, result))
+
+
+if __name__ == "__main__":
+    import aiounittest
+    import queue
+    import unittest
+    from unittest.mock import patch
+
+    from .loopback import SimulatedSisbot
+    from .table import Table
+
+    class InProcessShard:
+        """Stands in for a worker process: runs _shard_main on this loop"""
+
+        def __init__(self, ips: List[str], event_queue: Any):
+            self.command_queue: Any = queue.Queue()
+            self.task = asyncio.ensure_future(
+                _shard_main(ips, self.command_queue, event_queue))
+            self.exitcode: Optional[int] = None
+
+        def is_alive(self) -> bool:
+            return self.exitcode is None
+
+        def join(self) -> None:
+            pass
+
+    class ShardedFleetTests(aiounittest.AsyncTestCase):
+        def setUp(self) -> None:
+            self.sisbots: Dict[str, SimulatedSisbot] = {}
+            connect = Table.connect
+
+            async def connect_simulated(ip: str) -> Table:
+                sisbot = self.sisbots[ip] = SimulatedSisbot(id=ip)
+                return await connect(ip, transport_factory=sisbot.transport_factory())
+
+            self.patcher = patch.object(Table, "connect", connect_simulated)
+            self.patcher.start()
+
+        def tearDown(self) -> None:
+            self.patcher.stop()
+
+        async def start(self, fleet: ShardedFleet) -> List[InProcessShard]:
+            fleet._event_queue = queue.Queue()
+            fleet._ready = asyncio.get_running_loop().create_future()
+            shards = [
+                InProcessShard(
+                    [ip for ip, s in fleet._shard_by_ip.items() if s == shard],
+                    fleet._event_queue)
+                for shard in range(fleet.num_shards)]
+            fleet._processes = shards
+            fleet._command_queues = [shard.command_queue for shard in shards]
+            fleet._reader = asyncio.ensure_future(fleet._read_events())
+            fleet._watcher = asyncio.ensure_future(fleet._watch_processes())
+            await asyncio.wait_for(fleet._ready, 5)
+            return shards
+
+        async def stop(self, fleet: ShardedFleet, shards: List[InProcessShard]) -> None:
+            await fleet.stop()
+            await asyncio.gather(*[shard.task for shard in shards])
+
+        async def test_deltas_merge_into_read_view(self) -> None:
+            fleet = ShardedFleet(["a"], num_shards=1)
+            shards = await self.start(fleet)
+            self.assertEqual(fleet.get_table_data("a")["speed"], 0.3)  # type: ignore
+            notified: List[str] = []
+            fleet.add_listener(notified.append)
+
+            await asyncio.wait_for(fleet.call("a", "set_speed", 0.7), 5)
+            sisbot = self.sisbots["a"]
+            await sisbot.push(sisbot._set_sisbot(brightness=0.9))
+            while fleet.get_table_data("a")["brightness"] != 0.9:  # type: ignore
+                await asyncio.sleep(0.01)
+
+            data = fleet.get_table_data("a")
+            self.assertEqual(data["speed"], 0.7)  # type: ignore
+            self.assertEqual(data["name"], "Simulated Table")  # type: ignore
+            self.assertIn("a", notified)
+            await self.stop(fleet, shards)
+
+        async def test_commands_go_to_owning_shard(self) -> None:
+            fleet = ShardedFleet(["a", "b"], num_shards=2)
+            shards = await self.start(fleet)
+            self.assertEqual(fleet._shard_by_ip, {"a": 0, "b": 1})
+
+            await asyncio.wait_for(fleet.call("b", "set_brightness", 0.2), 5)
+            self.assertEqual(self.sisbots["b"].sisbot["brightness"], 0.2)
+            self.assertEqual(self.sisbots["a"].sisbot["brightness"], 0.5)
+
+            with self.assertRaises(ValueError):
+                await fleet.call("c", "pause")
+            with self.assertRaises(ValueError):
+                await fleet.call("a", "close")
+            await self.stop(fleet, shards)
+
+        async def test_dead_worker_fails_pending_calls(self) -> None:
+            fleet = ShardedFleet(["a"], num_shards=1, watch_interval=0.01)
+            shards = await self.start(fleet)
+            # The worker takes no more commands, then exits
+            shards[0].command_queue.put(("stop",))
+            await shards[0].task
+            call = asyncio.ensure_future(fleet.call("a", "pause"))
+            await asyncio.sleep(0)
+            shards[0].exitcode = -9
+
+            with self.assertRaises(Exception):
+                await asyncio.wait_for(call, 1)
+            self.assertIn("a", fleet.errors)
+            with self.assertRaises(Exception):
+                await fleet.call("a", "pause")
+            await self.stop(fleet, shards)
+
+    unittest.main()
@@ -0,0 +1,388 @@
+r"""
+Synchronous wrappers for driving tables from code that isn't running an
+asyncio event loop. All tables share one event loop running in a background
+thread; each call from another thread is scheduled onto that loop.
+
+Properties are read straight from the cached table state, so they don't cross
+threads. Commands block until the table has accepted them; each also has a
+``_nowait`` variant that returns a ``concurrent.futures.Future`` immediately.
+"""
+
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import (Any, Awaitable, Callable, Coroutine, Dict, Iterator, List,
+                    Optional, TypeVar)
+
+import asyncio
+import concurrent.futures
+import threading
+
+from .eventloop import new_event_loop
+from .table import Table
+
+T = TypeVar("T")
+
+SyncListener = Callable[[], None]
+
+
+class LoopThread:
+    """An asyncio event loop running forever in a daemon thread."""
+
+    _shared: Optional["LoopThread"] = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls) -> "LoopThread":
+        """The loop thread used by SyncTable and SyncFleet by default"""
+        with cls._shared_lock:
+            if cls._shared is None or not cls._shared.is_running:
+                cls._shared = LoopThread()
+            return cls._shared
+
+    def __init__(self, debug: bool = False, use_uvloop: Optional[bool] = None):
+        """use_uvloop is as for eventloop.new_event_loop: by default uvloop is
+used if it is installed"""
+        self._loop = new_event_loop(use_uvloop)
+        self._loop.set_debug(debug)
+        self._thread = threading.Thread(
+            target=self._loop.run_forever,
+            name="sisyphus-control-loop",
+            daemon=True)
+        self._thread.start()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread.is_alive()
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> "Future[T]":
+        """Schedule coro on the loop without waiting for it"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        """Run coro on the loop and wait for its result. If it doesn't finish
+within timeout seconds, it is cancelled and concurrent.futures.TimeoutError
+is raised."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("LoopThread.run called from the loop thread")
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # Otherwise it keeps running on the loop with nobody waiting
+            future.cancel()
+            raise
+
+    def call_soon(self, callback: Callable[..., Any], *args: Any) -> None:
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self) -> None:
+        """Stop the loop and wait for the thread to exit"""
+        if self.is_running:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._loop.close()
+
+
+class SyncTable:
+    """Synchronous wrapper around a Table. Attributes not defined here, such
+as name, state or get_playlist_by_id, are read from the wrapped Table. Use
+run() for coroutines on other objects, such as Playlist.play()."""
+
+    @classmethod
+    def connect(
+            cls,
+            ip: str,
+            loop_thread: Optional[LoopThread] = None,
+            timeout: Optional[float] = None,
+            **options: Any) -> "SyncTable":
+        """options (such as transport_factory, heartbeat_interval or
+rate_limits) are passed to Table.connect"""
+        loop_thread = loop_thread or LoopThread.shared()
+        return SyncTable(
+            loop_thread.run(Table.connect(ip, **options), timeout), loop_thread)
+
+    def __init__(self, table: Table, loop_thread: Optional[LoopThread] = None):
+        self._table = table
+        self._loop_thread = loop_thread or LoopThread.shared()
+        self._listeners: Dict[SyncListener, Callable[[], None]] = {}
+        self._default_executor: Optional[Executor] = None
+
+    def __enter__(self) -> "SyncTable":
+        return self
+
+    def __exit__(self, *args: Any) -> bool:
+        self.close()
+        return False
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        value = getattr(self._table, name)
+        if asyncio.iscoroutinefunction(value):
+            raise AttributeError(
+                "{name} is a coroutine; use SyncTable.run(table.{name}(...))".format(
+                    name=name))
+        return value
+
+    @property
+    def table(self) -> Table:
+        return self._table
+
+    @property
+    def loop_thread(self) -> LoopThread:
+        return self._loop_thread
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        return self._loop_thread.run(coro, timeout)
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> "Future[T]":
+        return self._loop_thread.submit(coro)
+
+    def close(self) -> None:
+        self.run(self._table.close())
+        self._shutdown_executor()
+
+    def refresh(self) -> None:
+        self.run(self._table.refresh())
+
+    def play(self) -> None:
+        self.run(self._table.play())
+
+    def play_nowait(self) -> "Future[None]":
+        return self.submit(self._table.play())
+
+    def pause(self) -> None:
+        self.run(self._table.pause())
+
+    def pause_nowait(self) -> "Future[None]":
+        return self.submit(self._table.pause())
+
+    def sleep(self) -> None:
+        self.run(self._table.sleep())
+
+    def sleep_nowait(self) -> "Future[None]":
+        return self.submit(self._table.sleep())
+
+    def wakeup(self) -> None:
+        self.run(self._table.wakeup())
+
+    def wakeup_nowait(self) -> "Future[None]":
+        return self.submit(self._table.wakeup())
+
+    def set_brightness(self, level: float) -> None:
+        self.run(self._table.set_brightness(level))
+
+    def set_brightness_nowait(self, level: float) -> "Future[None]":
+        return self.submit(self._table.set_brightness(level))
+
+    def set_speed(self, speed: float) -> None:
+        self.run(self._table.set_speed(speed))
+
+    def set_speed_nowait(self, speed: float) -> "Future[None]":
+        return self.submit(self._table.set_speed(speed))
+
+    def set_shuffle(self, value: bool) -> None:
+        self.run(self._table.set_shuffle(value))
+
+    def set_shuffle_nowait(self, value: bool) -> "Future[None]":
+        return self.submit(self._table.set_shuffle(value))
+
+    def set_loop(self, value: bool) -> None:
+        self.run(self._table.set_loop(value))
+
+    def set_loop_nowait(self, value: bool) -> "Future[None]":
+        return self.submit(self._table.set_loop(value))
+
+    def wait_for(self, pred: Callable[[], bool], timeout: Optional[float] = None) -> None:
+        self.run(self._table.wait_for(pred), timeout)
+
+    def add_listener(
+            self,
+            listener: SyncListener,
+            executor: Optional[Executor] = None) -> None:
+        """Call listener whenever the table state changes. Listeners are
+called on executor, never on the loop thread; by default a single worker
+thread per SyncTable, so they run one at a time in order."""
+        if executor is None:
+            executor = self._get_default_executor()
+
+        def dispatch() -> None:
+            executor.submit(listener)  # type: ignore
+
+        self._listeners[listener] = dispatch
+        self._loop_thread.call_soon(self._table.add_listener, dispatch)
+
+    def remove_listener(self, listener: SyncListener) -> None:
+        dispatch = self._listeners.pop(listener)
+        self._loop_thread.call_soon(self._table.remove_listener, dispatch)
+
+    def _shutdown_executor(self) -> None:
+        if self._default_executor is not None:
+            self._default_executor.shutdown(wait=False)
+            self._default_executor = None
+
+    def _get_default_executor(self) -> Executor:
+        if self._default_executor is None:
+            self._default_executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix="sisyphus-control-listener")
+        return self._default_executor
+
+
+class SyncFleet:
+    """Synchronous wrapper around many tables sharing one loop thread."""
+
+    @classmethod
+    def connect(
+            cls,
+            ips: List[str],
+            loop_thread: Optional[LoopThread] = None,
+            timeout: Optional[float] = None,
+            **options: Any) -> "SyncFleet":
+        """Connect to all the tables concurrently, passing options to
+Table.connect. If any connection fails, the ones that succeeded are closed
+and the error is raised."""
+        loop_thread = loop_thread or LoopThread.shared()
+        tables = loop_thread.run(_connect_all(ips, options), timeout)
+        return SyncFleet([SyncTable(table, loop_thread) for table in tables])
+
+    def __init__(self, tables: List[SyncTable]):
+        self._tables = tables
+
+    def __enter__(self) -> "SyncFleet":
+        return self
+
+    def __exit__(self, *args: Any) -> bool:
+        self.close()
+        return False
+
+    def __iter__(self) -> Iterator[SyncTable]:
+        return iter(self._tables)
+
+    def __len__(self) -> int:
+        return len(self._tables)
+
+    @property
+    def tables(self) -> List[SyncTable]:
+        return list(self._tables)
+
+    def get_table_by_ip(self, ip: str) -> Optional[SyncTable]:
+        for table in self._tables:
+            if table.table._get_transport().ip == ip:
+                return table
+        return None
+
+    def run_all(
+            self,
+            func: Callable[[Table], Awaitable[T]],
+            timeout: Optional[float] = None) -> List[T]:
+        """Run func on every table concurrently and wait for all of them"""
+        if not self._tables:
+            return []
+
+        async def run_all() -> List[T]:
+            return list(await asyncio.gather(
+                *[func(table.table) for table in self._tables]))
+
+        return self._tables[0].loop_thread.run(run_all(), timeout)
+
+    def close(self) -> None:
+        self.run_all(lambda table: table.close())
+        for table in self._tables:
+            table._shutdown_executor()
+
+
+async def _connect_all(ips: List[str], options: Dict[str, Any]) -> List[Table]:
+    results = await asyncio.gather(
+        *[Table.connect(ip, **options) for ip in ips], return_exceptions=True)
+    tables = [result for result in results if isinstance(result, Table)]
+    for result in results:
+        if isinstance(result, BaseException):
+            await asyncio.gather(*[table.close() for table in tables])
+            raise result
+    return tables
+
+
+if __name__ == "__main__":
+    import unittest
+
+    from .loopback import SimulatedSisbot
+
+    class SyncTableTests(unittest.TestCase):
+        loop_thread: LoopThread
+
+        @classmethod
+        def setUpClass(cls) -> None:
+            cls.loop_thread = LoopThread()
+
+        @classmethod
+        def tearDownClass(cls) -> None:
+            cls.loop_thread.stop()
+
+        def setUp(self) -> None:
+            sisbot = SimulatedSisbot()
+            self.table = SyncTable.connect(
+                "loopback",
+                loop_thread=self.loop_thread,
+                timeout=1,
+                transport_factory=sisbot.transport_factory())
+
+        def tearDown(self) -> None:
+            self.table.close()
+
+        def test_nowait_returns_future(self) -> None:
+            future = self.table.set_speed_nowait(0.4)
+            self.assertIsInstance(future, Future)
+            future.result(1)
+            self.assertEqual(self.table.speed, 0.4)
+
+            self.table.set_brightness(0.7)
+            self.assertEqual(self.table.brightness, 0.7)
+
+        def test_listeners_run_on_executor(self) -> None:
+            called = threading.Event()
+            threads: List[str] = []
+
+            def listener() -> None:
+                threads.append(threading.current_thread().name)
+                called.set()
+
+            self.table.add_listener(listener)
+            self.table.set_speed(0.9)
+            self.assertTrue(called.wait(1))
+            self.assertTrue(threads[0].startswith("sisyphus-control-listener"))
+
+            self.table.remove_listener(listener)
+            called.clear()
+            self.table.set_speed(0.1)
+            self.assertFalse(called.wait(0.1))
+
+            with ThreadPoolExecutor(thread_name_prefix="custom") as executor:
+                self.table.add_listener(listener, executor)
+                self.table.set_speed(0.2)
+                self.assertTrue(called.wait(1))
+            self.assertTrue(threads[-1].startswith("custom"))
+
+        def test_timed_out_wait_is_cancelled(self) -> None:
+            for _ in range(3):
+                with self.assertRaises(concurrent.futures.TimeoutError):
+                    self.table.wait_for(lambda: False, timeout=0.05)
+
+            async def pending_waits() -> int:
+                await asyncio.sleep(0)
+                return len([
+                    task for task in asyncio.all_tasks()
+                    if getattr(task.get_coro(), "__qualname__", "") == "Table.wait_for"])
+
+            self.assertEqual(self.table.run(pending_waits(), 1), 0)
+
+            # A waiter still gets the wakeup
+            waiting = self.table.submit(
+                self.table.table.wait_for(lambda: self.table.speed == 0.6))
+            self.table.set_speed(0.6)
+            waiting.result(1)
+
+    unittest.main()
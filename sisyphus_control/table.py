@@ -1,20 +1,31 @@
 from datetime import datetime, timedelta, timezone
 from types import TracebackType
-from typing import Any, Awaitable, Callable, Dict, List, Optional, Type, TypeVar, Union
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Type, TypeVar, Union
 
 import asyncio
 import logging
 
-import aiohttp
-
 from .data import Collection, Model
+from .duration import DurationModel
+from .health import HealthState
+from .listeners import ListenerRegistry, Subscription
 from .log import log_data_change
 from .playlist import Playlist
+from .ratelimit import EndpointClass, get_rate_limiter
+from .scheduler import Priority
 from .sisbot_json import parse_bool
 from .track import Track
-from .transport import TableTransport, post
-from .util import ensure_coroutine
+from .transport import TableTransport, Transport, TransportFactory, post
+from .util import LRUCache
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+    import aiohttp
 
+    from .capture import TrafficRecorder
+    from .geometry import TrackGeometry
+    from .playlist import PlaybackOrder
 
 _LOGGER = logging.getLogger("sisyphus-control")
 
@@ -26,7 +37,7 @@ class Table:
     @classmethod
     async def find_table_ips(
             cls: Type['Table'],
-            session: Optional[aiohttp.ClientSession] = None) -> List[str]:
+            session: Optional["aiohttp.ClientSession"] = None) -> List[str]:
         _LOGGER.info("Searching for tables...")
         import netifaces
 
@@ -63,32 +74,86 @@ class Table:
     async def connect(
             cls: Type['Table'],
             ip: str,
-            session: Optional[aiohttp.ClientSession] = None) -> 'Table':
+            session: Optional["aiohttp.ClientSession"] = None,
+            recorder: Optional["TrafficRecorder"] = None,
+            heartbeat_interval: Optional[float] = None,
+            offline_after: Optional[float] = None,
+            transport_factory: Optional[TransportFactory] = None,
+            max_concurrency: int = 1,
+            fail_fast: bool = False,
+            rate_limits: Optional[Dict[EndpointClass, Tuple[float, int]]] = None) -> 'Table':
         """Connect to the table with the given IP and return a Table object
-        that can be used to control it"""
+        that can be used to control it. If a recorder is given, all traffic
+        with the table is recorded to it. If a heartbeat_interval is given,
+        the table is pinged that often (in seconds) to keep health
+        up to date, and marked offline after offline_after seconds without
+        a successful ping (three intervals by default).
+
+        At most max_concurrency requests of each priority are sent to the
+        table at once; one extra request slot is kept for commands, so they
+        never wait for a background transfer such as a geometry download.
+        Requests are rate limited per IP; rate_limits maps endpoint classes to
+        (requests per second, burst) and replaces the limits for every Table
+        connected to ip. With fail_fast, a command that would exceed its rate
+        limit raises RateLimitExceeded instead of waiting.
+
+        To talk to the table some other way than HTTP and socket.io (for
+        example LoopbackTransport), pass a transport_factory; it is called
+        with ip and the callback the transport must deliver updates to, and
+        the other transport options are ignored."""
         table = Table()
-        table._transport = TableTransport(
-            ip,
-            callback=table._try_update_table_state,
-            session=session)
+        if rate_limits is not None:
+            rate_limiter = get_rate_limiter(ip)
+            for endpoint_class, (rate, burst) in rate_limits.items():
+                rate_limiter.configure(endpoint_class, rate, burst)
+        if transport_factory is not None:
+            table._transport = transport_factory(
+                ip, table._try_update_table_state)
+        else:
+            table._transport = TableTransport(
+                ip,
+                callback=table._try_update_table_state,
+                session=session,
+                max_concurrency=max_concurrency,
+                fail_fast=fail_fast,
+                recorder=recorder,
+                heartbeat_interval=heartbeat_interval,
+                offline_after=offline_after,
+                health_callback=table._on_health_changed)
         await table._transport.post("connect")
 
         _LOGGER.debug("Connected to %s (%s)", table.name, ip)
         return table
 
     def __init__(self):
-        self._transport: Optional[TableTransport] = None
+        self._transport: Optional[Transport] = None
         self._collection: Collection = Collection()
         self._data: Model = Model({})
-        self._listeners: List[TableListenerType] = []
+        self._listeners: ListenerRegistry = ListenerRegistry()
         self._updated: asyncio.Event = asyncio.Event()
         self._remaining_time: timedelta = timedelta()
         self._total_time: timedelta = timedelta()
         self._remaining_time_as_of: Optional[datetime] = None
         self._connected: bool = False
+        self._duration_model: DurationModel = DurationModel()
+        self._playback_orders: Dict[str, "PlaybackOrder"] = {}
+        # Downloads by track ID and version, shared by concurrent callers
+        self._geometry_cache: "LRUCache[Tuple[str, Any], asyncio.Future[TrackGeometry]]" = (
+            LRUCache(32))
+        self._prefetch_count = 0
+        self._prefetch_executor: Optional["Executor"] = None
+        self._prefetched_track_id: Optional[str] = None
+        self._background_tasks: Set["asyncio.Future[Any]"] = set()
+        self._calibration_downloads = False
+        # Track times reported before the track's path length was known, by
+        # track ID; applied once its geometry has been downloaded
+        self._pending_observations: Dict[str, Tuple[float, timedelta]] = {}
+        self._uncalibrated_track_ids: Set[str] = set()
         self._collection.add_listener(self._notify_listeners)
 
     async def close(self) -> None:
+        for task in list(self._background_tasks):
+            task.cancel()
         if self._transport is not None:
             await self._transport.close()
             _LOGGER.info(
@@ -111,6 +176,14 @@ class Table:
     def is_connected(self) -> bool:
         return self._connected
 
+    @property
+    def health(self) -> HealthState:
+        """UNKNOWN unless the table was connected with a heartbeat_interval.
+Listeners are notified when it changes."""
+        if self._transport is None or self._transport.health is None:
+            return HealthState.UNKNOWN
+        return self._transport.health.state
+
     @property
     def id(self) -> str:
         return self._data["id"]
@@ -144,11 +217,11 @@ incomplete) list of possible values:
 
     async def pause(self) -> None:
         if self.state != 'paused':
-            await self._get_transport().post("pause")
+            await self._post_optimistic(self._data, {"state": "paused"}, "pause")
 
     async def play(self) -> None:
         if self.state != 'playing':
-            await self._get_transport().post("play")
+            await self._post_optimistic(self._data, {"state": "playing"}, "play")
 
     @property
     def is_sleeping(self) -> bool:
@@ -217,7 +290,9 @@ incomplete) list of possible values:
     async def set_brightness(self, level: float) -> None:
         if not 0 <= level <= 1.0:
             raise ValueError("Brightness must be between 0 and 1 inclusive")
-        await self._get_transport().post(
+        await self._post_optimistic(
+            self._data,
+            {"brightness": level},
             "set_brightness",
             {"value": level})
 
@@ -228,7 +303,9 @@ incomplete) list of possible values:
     async def set_speed(self, speed: float) -> None:
         if not 0 <= speed <= 1.0:
             raise ValueError("Speed must be between 0 and 1 inclusive")
-        await self._get_transport().post(
+        await self._post_optimistic(
+            self._data,
+            {"speed": speed},
             "set_speed",
             {"value": speed})
 
@@ -240,15 +317,19 @@ incomplete) list of possible values:
         if not self.active_playlist:
             raise Exception("Cannot shuffle when there is no active playlist")
 
-        await self.active_playlist.set_shuffle(value)
-        self._data["is_shuffle"] = str(value).lower()
+        await self._update_optimistic(
+            self._data,
+            {"is_shuffle": str(value).lower()},
+            lambda: self.active_playlist.set_shuffle(value))  # type: ignore
 
     @property
     def is_loop(self) -> bool:
         return parse_bool(self._data["is_loop"])
 
     async def set_loop(self, value: bool) -> None:
-        await self._get_transport().post(
+        await self._post_optimistic(
+            self._data,
+            {"is_loop": str(value).lower()},
             "set_loop",
             {"value": str(value).lower()})
 
@@ -264,9 +345,98 @@ incomplete) list of possible values:
     def active_track_remaining_time_as_of(self) -> Optional[datetime]:
         return self._remaining_time_as_of
 
+    @property
+    def duration_model(self) -> DurationModel:
+        """Estimates track play times for this table; calibrated from the
+track times the table reports for tracks whose path length is known (see
+enable_calibration)"""
+        return self._duration_model
+
+    def enable_calibration(self, download: bool = True) -> None:
+        """Whenever the table plays a track whose path length isn't known
+yet, download its geometry in the background so that the play time the table
+reports can calibrate duration_model. Off by default, since it downloads
+every track played from the table; without it, only tracks whose path length
+is already known (for example from prefetch or duration estimates) are used.
+Requires numpy; download=False disables."""
+        self._calibration_downloads = download
+
+    def enable_prefetch(
+            self,
+            count: int = 2,
+            executor: Optional["Executor"] = None) -> None:
+        """Whenever the active track changes, start downloading the geometry
+and rendering the thumbnails of the next count tracks of the active playlist
+in the background (thumbnails are rendered on executor), so they are ready
+by the time the table plays them. Requires numpy; count=0 disables."""
+        self._prefetch_count = count
+        self._prefetch_executor = executor
+        self._prefetched_track_id = None
+
+    def prefetch_upcoming(self, count: int = 2) -> List[Track]:
+        """Start prefetching the next count tracks now. Returns the tracks."""
+        playlist = self.active_playlist
+        if playlist is None:
+            return []
+
+        tracks = playlist.upcoming_tracks(count)
+        for track in tracks:
+            self._run_in_background(self._prefetch(track))
+        return tracks
+
+    async def _prefetch(self, track: Track) -> None:
+        try:
+            await track.get_path_length()
+            await track.render_thumbnails(self._prefetch_executor)
+        except Exception as e:
+            _LOGGER.debug("Prefetching %s failed: %s", track.name, e)
+
+    def _maybe_prefetch(self) -> None:
+        if not self._prefetch_count or not self._data or self._transport is None:
+            return
+        active_track = self._data.get("active_track")
+        track_id = active_track.get("id") if active_track else None
+        if track_id is None or track_id == self._prefetched_track_id:
+            return
+        self._prefetched_track_id = track_id
+        self.prefetch_upcoming(self._prefetch_count)
+
+    def _observe_track_time(self, track_id: str, total_time: timedelta) -> None:
+        model = self._duration_model
+        if model.get_path_length(track_id) is not None:
+            model.observe_track(track_id, self.speed, total_time)
+            return
+        if (not self._calibration_downloads
+                or self._transport is None
+                or track_id in self._uncalibrated_track_ids):
+            return
+
+        # Keep only the latest report; fetch the path length once
+        fetching = track_id in self._pending_observations
+        self._pending_observations[track_id] = (self.speed, total_time)
+        if not fetching:
+            self._run_in_background(self._calibrate(self.active_track))
+
+    async def _calibrate(self, track: Track) -> None:
+        try:
+            await track.get_path_length()
+        except Exception as e:
+            _LOGGER.debug("Cannot calibrate durations with %s: %s", track.name, e)
+            self._uncalibrated_track_ids.add(track.id)
+            return
+        finally:
+            speed, total_time = self._pending_observations.pop(track.id)
+        self._duration_model.observe_track(track.id, speed, total_time)
+
+    def _run_in_background(self, coro: Awaitable[Any]) -> None:
+        task = asyncio.ensure_future(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
     async def refresh(self) -> None:
-        await self._get_transport().post("state")
-        await self._get_transport().post("get_track_time")
+        await self._get_transport().post("state", priority=Priority.BACKGROUND)
+        await self._get_transport().post(
+            "get_track_time", priority=Priority.BACKGROUND)
 
     async def wait_for(self, pred: Callable[[], bool]) -> None:
         while True:
@@ -275,19 +445,67 @@ incomplete) list of possible values:
             if pred():
                 return
 
-    def add_listener(self, listener: TableListenerType) -> None:
-        self._listeners.append(listener)
+    def add_listener(self, listener: TableListenerType, weak: bool = False) -> Subscription:
+        """Call listener whenever the table state changes. With weak, the
+listener is held by weak reference and dropped once its owner is garbage
+collected. The returned Subscription can be used to remove the listener."""
+        return self._listeners.add(listener, weak)
 
     def remove_listener(self, listener: TableListenerType) -> None:
         self._listeners.remove(listener)
 
     async def _notify_listeners(self) -> None:
-        listeners = list(self._listeners)
-        for listener in listeners:
-            await ensure_coroutine(listener)()  # type: ignore
+        await self._listeners.notify()
         self._updated.set()
 
-    def _get_transport(self) -> TableTransport:
+    async def _post_optimistic(
+            self,
+            model: Model,
+            changes: Dict[str, Any],
+            endpoint: str,
+            data: Optional[Dict[str, Any]] = None) -> None:
+        await self._update_optimistic(
+            model,
+            changes,
+            lambda: self._get_transport().post(endpoint, data))
+
+    async def _update_optimistic(
+            self,
+            model: Model,
+            changes: Dict[str, Any],
+            action: Callable[[], Awaitable[None]]) -> None:
+        """Apply changes to model and notify listeners right away, then run
+action. The table's response reconciles the model through the usual update
+path; if action fails, the changes are rolled back."""
+        previous = model.apply_optimistic(changes)
+        if previous:
+            await self._collection.report_changes(model, previous.keys())
+            await self._notify_listeners()
+
+        try:
+            await action()
+        except Exception:
+            if model.rollback(changes, previous):
+                await self._collection.report_changes(model, previous.keys())
+                await self._notify_listeners()
+            raise
+
+    async def _on_health_changed(self, state: HealthState) -> None:
+        # Heartbeats bypass the transport callback, so this is the only
+        # place a recovery is seen until the next post or socket event. A
+        # table is DEGRADED after a failed ping too, which is no recovery;
+        # only a slow but successful one is.
+        health = self._transport.health if self._transport is not None else None
+        if state == HealthState.OFFLINE:
+            self._connected = False
+        elif state == HealthState.HEALTHY or (
+                state == HealthState.DEGRADED
+                and health is not None
+                and health.consecutive_failures == 0):
+            self._connected = True
+        await self._notify_listeners()
+
+    def _get_transport(self) -> Transport:
         if self._transport is not None:
             return self._transport
 
@@ -313,10 +531,16 @@ incomplete) list of possible values:
                     self._total_time = timedelta(
                         milliseconds=data["total_time"])
                     self._remaining_time_as_of = datetime.now(timezone.utc)
+                    active_track = self._data.get("active_track")
+                    if (active_track and active_track.get("id") != "false"
+                            and "speed" in self._data):
+                        self._observe_track_time(active_track["id"], self._total_time)
                     await self._notify_listeners()
                 else:
                     continue
 
+            self._maybe_prefetch()
+
         elif table_result is None:
             self._connected = False
             await self._notify_listeners()
@@ -329,7 +553,7 @@ incomplete) list of possible values:
 # noinspection PyBroadException
 async def _ping_table(
         ip: str,
-        session: Optional[aiohttp.ClientSession] = None) -> Optional[str]:
+        session: Optional["aiohttp.ClientSession"] = None) -> Optional[str]:
     try:
         await post(
             ip,
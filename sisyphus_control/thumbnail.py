@@ -0,0 +1,95 @@
+r"""
+Renders track thumbnails locally from track geometry, instead of fetching
+them from the table's thumbnail server. Requires numpy (the ``geometry``
+extra).
+"""
+
+from typing import Any, Dict, Iterable, Tuple
+
+import struct
+import zlib
+
+import numpy as np
+
+from .util import LRUCache
+
+BACKGROUND = 255
+PATH = 0
+
+
+def render_thumbnails(
+        theta: np.ndarray,
+        rho: np.ndarray,
+        sizes: Iterable[int]) -> Dict[int, bytes]:
+    """Renders a grayscale PNG of the path for each size. The path is
+interpolated once, at the resolution of the largest size, and every size is
+rasterized from those points. Module-level so that it can be run in a
+ProcessPoolExecutor."""
+    sizes = sorted(set(int(size) for size in sizes))
+    if not sizes:
+        return {}
+
+    x, y = _interpolate(theta, rho, sizes[-1])
+    return {size: encode_png(rasterize(x, y, size)) for size in sizes}
+
+
+def rasterize(x: np.ndarray, y: np.ndarray, size: int) -> np.ndarray:
+    """Plots points in [-1, 1] x [-1, 1] onto a size x size image, with +y
+up. The points must be dense enough that neighbours fall in adjacent
+pixels."""
+    image = np.full((size, size), BACKGROUND, dtype=np.uint8)
+    scale = (size - 1) / 2
+    cols = np.clip(np.rint((x + 1) * scale), 0, size - 1).astype(np.intp)
+    rows = np.clip(np.rint((1 - y) * scale), 0, size - 1).astype(np.intp)
+    image[rows, cols] = PATH
+    return image
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    """Encodes a 2D uint8 array as an 8-bit grayscale PNG."""
+    height, width = image.shape
+    # Each scanline is prefixed with filter type 0 (none)
+    raw = np.zeros((height, width + 1), dtype=np.uint8)
+    raw[:, 1:] = image
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", header),
+        _png_chunk(b"IDAT", zlib.compress(raw.tobytes())),
+        _png_chunk(b"IEND", b""),
+    ])
+
+
+# Rendered thumbnails, keyed by (track ID, version)
+thumbnail_cache: "LRUCache[Tuple[str, Any], Dict[int, bytes]]" = LRUCache(256)
+
+
+def _interpolate(theta: np.ndarray, rho: np.ndarray, size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The ball moves linearly in theta and rho between vertices, which is a
+spiral in Cartesian space. Subdivide each segment so that consecutive points
+are at most about half a pixel apart at the given size."""
+    if len(theta) < 2:
+        return rho * np.cos(theta), rho * np.sin(theta)
+
+    d_theta = np.diff(theta)
+    d_rho = np.diff(rho)
+    max_rho = np.maximum(np.abs(rho[:-1]), np.abs(rho[1:]))
+    distance = np.maximum(np.abs(d_rho), np.abs(d_theta) * max_rho)
+    steps = np.maximum(1, np.ceil(distance * size).astype(np.intp))
+
+    segments = np.repeat(np.arange(len(steps)), steps)
+    starts = np.cumsum(steps) - steps
+    t = (np.arange(len(segments)) - starts[segments]) / steps[segments]
+
+    all_theta = np.append(theta[segments] + d_theta[segments] * t, theta[-1])
+    all_rho = np.append(rho[segments] + d_rho[segments] * t, rho[-1])
+    return all_rho * np.cos(all_theta), all_rho * np.sin(all_theta)
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return b"".join([
+        struct.pack(">I", len(data)),
+        chunk_type,
+        data,
+        struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF),
+    ])
@@ -1,12 +1,21 @@
+from concurrent.futures import Executor
+from datetime import timedelta
 from enum import IntEnum
-from typing import Any, Dict, Union
+from typing import IO, TYPE_CHECKING, Any, Dict, Optional, Union
+
+import asyncio
+import os
 
 from sisyphus_control.data import Model
 
 from . import table
 from . import playlist
 from .log import log_data_change
-from .transport import TableTransport
+from .scheduler import Priority
+from .transport import Transport
+
+if TYPE_CHECKING:
+    from .geometry import TrackGeometry
 
 
 class Track:
@@ -23,9 +32,9 @@ occurrence is represented by its own Track object."""
         MEDIUM = 100
         LARGE = 400
 
-    def __init__(self, parent: Union['playlist.Playlist', 'table.Table'], transport: TableTransport, data: Model):
+    def __init__(self, parent: Union['playlist.Playlist', 'table.Table'], transport: Transport, data: Model):
         self.parent: Union['playlist.Playlist', 'table.Table'] = parent
-        self._transport: TableTransport = transport
+        self._transport: Transport = transport
         self._data: Model = data
 
     def __str__(self) -> str:
@@ -40,6 +49,12 @@ occurrence is represented by its own Track object."""
     def name(self) -> str:
         return self._data["name"]
 
+    @property
+    def version(self) -> Any:
+        """Changes when the track design is edited; None if the table
+doesn't report it."""
+        return self._data.get("version")
+
     @property
     def is_in_playlist(self) -> bool:
         return "_index" in self._data
@@ -63,3 +78,101 @@ This track's index in the owning playlist when the playlist is not shuffled"""
             host=self._transport.ip,
             size=size,
             id=self.id)
+
+    async def get_geometry(
+            self,
+            source: Union[None, str, "os.PathLike[str]", IO[str]] = None) -> "TrackGeometry":
+        """Returns the path of the track. By default the vertices are
+downloaded from the table; pass a path or text stream of .thr data to read
+them from there instead. Requires numpy."""
+        from .geometry import parse_thr
+
+        if source is not None:
+            return parse_thr(source)
+
+        # Downloads are cached per table, and concurrent requests for the
+        # same track share one download
+        cache = self._table._geometry_cache
+        key = (self.id, self.version)
+        geometry = cache.get(key)
+        if geometry is None:
+            geometry = asyncio.ensure_future(self._download_geometry())
+            cache.put(key, geometry)
+        try:
+            return await asyncio.shield(geometry)
+        except Exception:
+            if cache.get(key) is geometry:
+                del cache[key]
+            raise
+
+    async def _download_geometry(self) -> "TrackGeometry":
+        from .geometry import parse_thr_string
+
+        response: Any = await self._transport.post(
+            "get_track_verts",
+            {"id": self.id},
+            priority=Priority.BACKGROUND)
+        if isinstance(response, list) and response:
+            response = response[0]
+        if isinstance(response, dict):
+            response = response.get("verts")
+        if not isinstance(response, str):
+            raise Exception(
+                "Unexpected response for track {id} vertices".format(id=self.id))
+        return parse_thr_string(response)
+
+    async def get_path_length(self) -> float:
+        """Length of the track's path in table radii, cached per track ID on
+the table's duration model. Requires numpy the first time."""
+        model = self._table.duration_model
+        path_length = model.get_path_length(self.id)
+        if path_length is None:
+            path_length = (await self.get_geometry()).path_length
+            model.set_path_length(self.id, path_length)
+        return path_length
+
+    async def estimate_duration(self, speed: Optional[float] = None) -> timedelta:
+        """Estimated play time at the given speed (by default the table's
+current speed)"""
+        table = self._table
+        if speed is None:
+            speed = table.speed
+        return table.duration_model.estimate(await self.get_path_length(), speed)
+
+    @property
+    def _table(self) -> "table.Table":
+        if isinstance(self.parent, playlist.Playlist):
+            return self.parent.parent
+        return self.parent
+
+    async def render_thumbnails(
+            self,
+            executor: Optional[Executor] = None) -> Dict["Track.ThumbnailSize", bytes]:
+        """Renders PNG thumbnails of every ThumbnailSize locally from the
+track's geometry, rather than having the table render them. Results are
+cached by track ID and version. Rendering runs in executor (the event loop's
+default executor if None). Requires numpy."""
+        from .thumbnail import thumbnail_cache
+
+        thumbnails = thumbnail_cache.get((self.id, self.version))
+        if thumbnails is None:
+            geometry = await self.get_geometry()
+            thumbnails = await _render_in_executor(geometry, executor)
+            thumbnail_cache.put((self.id, self.version), thumbnails)
+
+        return {
+            Track.ThumbnailSize(size): png
+            for size, png in thumbnails.items()}
+
+
+async def _render_in_executor(
+        geometry: "TrackGeometry",
+        executor: Optional[Executor]) -> Dict[int, bytes]:
+    from .thumbnail import render_thumbnails
+
+    return await asyncio.get_running_loop().run_in_executor(
+        executor,
+        render_thumbnails,
+        geometry.theta,
+        geometry.rho,
+        [int(size) for size in Track.ThumbnailSize])
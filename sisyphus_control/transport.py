@@ -1,29 +1,31 @@
+from abc import ABC, abstractmethod
 from types import TracebackType
-from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Type
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Tuple, Type
 
-import aiohttp
 import asyncio
 import json
-import socketio_v4 as socketio
+import time
+
+from .health import HealthCallback, HealthMonitor
+from .ratelimit import RateLimiter, get_rate_limiter
+from .scheduler import CommandScheduler, Priority
+
+# aiohttp and socketio are slow to import, so they're only imported once a
+# table is actually contacted
+if TYPE_CHECKING:
+    import aiohttp
+
+    from .capture import TrafficRecorder
 
 TransportCallback = Callable[[Optional[List[Dict[str, Any]]]], Awaitable[None]]
 
 
-class TableTransport:
-    def __init__(
-        self,
-        ip: str,
-        callback: Optional[TransportCallback] = None,
-        session: Optional[aiohttp.ClientSession] = None,
-    ):
-        self._session = session
-        self._ip = ip
-        self._callback = callback
-        self._wants_to_close = False
-        self._event_loop = asyncio.get_event_loop()
-        self._socket_closed = self._event_loop.create_task(self._run_socket())
+class Transport(ABC):
+    """How a Table talks to its sisbot. Implementations deliver every
+response from post(), and every unsolicited state update, to the callback
+they were created with; None tells the table the connection was lost."""
 
-    async def __aenter__(self) -> "TableTransport":
+    async def __aenter__(self) -> "Transport":
         return self
 
     async def __aexit__(
@@ -35,32 +37,175 @@ class TableTransport:
         await self.close()
         return False
 
+    @property
+    @abstractmethod
+    def ip(self) -> str:
+        ...
+
+    @property
+    def health(self) -> Optional[HealthMonitor]:
+        return None
+
+    @abstractmethod
+    async def post(
+        self,
+        endpoint: str,
+        data: Optional[Dict[str, Any]] = None,
+        timeout: float = 5,
+        priority: Priority = Priority.INTERACTIVE,
+        fail_fast: Optional[bool] = None,
+    ) -> Any:
+        """Send a request to a sisbot endpoint and return the response"""
+        ...
+
+    @abstractmethod
+    async def close(self) -> None:
+        ...
+
+
+TransportFactory = Callable[[str, TransportCallback], Transport]
+
+
+class TableTransport(Transport):
+    """Talks to a table over HTTP (port 80) and socket.io (port 3002)."""
+
+    def __init__(
+        self,
+        ip: str,
+        callback: Optional[TransportCallback] = None,
+        session: Optional["aiohttp.ClientSession"] = None,
+        max_concurrency: int = 1,
+        fail_fast: bool = False,
+        recorder: Optional["TrafficRecorder"] = None,
+        heartbeat_interval: Optional[float] = None,
+        offline_after: Optional[float] = None,
+        health_callback: Optional[HealthCallback] = None,
+    ):
+        self._session = session
+        self._scheduler = CommandScheduler(max_concurrency=max_concurrency)
+        self._rate_limiter = get_rate_limiter(ip)
+        self._fail_fast = fail_fast
+        self._recorder = recorder
+        self._ip = ip
+        self._callback = callback
+        self._wants_to_close = False
+        # Bound to the running loop on first use, not here, so a transport can
+        # be created outside of (or before) the loop it will run on
+        self._event_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._socket_closed: Optional["asyncio.Task[None]"] = None
+        self._health: Optional[HealthMonitor] = None
+        if heartbeat_interval is not None:
+            self._health = HealthMonitor(
+                ip,
+                self._ping,
+                health_callback,
+                interval=heartbeat_interval,
+                offline_after=offline_after or 3 * heartbeat_interval)
+
     @property
     def ip(self) -> str:
         return self._ip
 
+    @property
+    def scheduler(self) -> CommandScheduler:
+        return self._scheduler
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        """Shared by every transport connected to this IP"""
+        return self._rate_limiter
+
+    @property
+    def health(self) -> Optional[HealthMonitor]:
+        """None unless a heartbeat_interval was given"""
+        return self._health
+
+    def start(self) -> None:
+        """Connect the socket and start the heartbeat on the running loop.
+post() does this on first use; call it directly to receive state updates
+before posting anything."""
+        loop = asyncio.get_running_loop()
+        if self._event_loop is not None:
+            if self._event_loop is not loop:
+                raise RuntimeError(
+                    "Transport for {ip} is bound to a different event loop".format(
+                        ip=self._ip))
+            return
+        self._event_loop = loop
+        self._socket_closed = loop.create_task(self._run_socket())
+        if self._health is not None:
+            self._health.start()
+
     async def close(self) -> None:
+        if self._health is not None:
+            await self._health.stop()
         if self._socket_closed:
             self._wants_to_close = True
             await self._socket_closed
+            self._socket_closed = None
 
     async def post(
-        self, endpoint: str, data: Dict[str, Any] = None, timeout: float = 5
-    ) -> None:
-        response = await post(self._ip, endpoint, data, timeout, session=self._session)
+        self,
+        endpoint: str,
+        data: Dict[str, Any] = None,
+        timeout: float = 5,
+        priority: Priority = Priority.INTERACTIVE,
+        fail_fast: Optional[bool] = None,
+    ) -> Any:
+        self.start()
+        if fail_fast is None:
+            fail_fast = self._fail_fast
+        # Wait for a token before queueing so that a poll waiting on its
+        # bucket doesn't hold a scheduler slot that a command could use;
+        # buckets serve waiting requests in priority order too
+        await self._rate_limiter.acquire(endpoint, fail_fast, priority)
+        response = await self._scheduler.run(
+            lambda: self._post(endpoint, data, timeout),
+            priority,
+        )
         if self._callback:
             await self._callback(response)
+        return response
+
+    async def _ping(self, timeout: float) -> None:
+        # Bypasses the scheduler and rate limiter so the latency measured is
+        # the network's and the table's, not our own queueing delay
+        await post(self._ip, "exists", timeout=timeout, session=self._session)
+
+    async def _post(
+        self, endpoint: str, data: Optional[Dict[str, Any]], timeout: float
+    ) -> List[Dict[str, Any]]:
+        if self._recorder is None:
+            return await post(self._ip, endpoint, data, timeout, session=self._session)
+
+        start = time.monotonic()
+        try:
+            response = await post(
+                self._ip, endpoint, data, timeout, session=self._session)
+        except Exception as e:
+            self._recorder.record_http(
+                endpoint, data, None, e, time.monotonic() - start)
+            raise
+        self._recorder.record_http(
+            endpoint, data, response, None, time.monotonic() - start)
+        return response
 
     async def _run_socket(self) -> None:
+        import socketio_v4 as socketio
+
         sio = socketio.AsyncClient()
 
         @sio.event
         async def disconnect() -> None:
+            if self._recorder is not None:
+                self._recorder.record_socket("disconnect", None)
             if self._callback is not None:
                 await self._callback(None)
 
         @sio.event
         async def set(updates: List[Dict[str, Any]]) -> None:
+            if self._recorder is not None:
+                self._recorder.record_socket("set", updates)
             if self._callback is not None:
                 await self._callback(updates)
 
@@ -78,8 +223,9 @@ async def post(
     endpoint: str,
     data: Dict[str, Any] = None,
     timeout: float = 5,
-    session: Optional[aiohttp.ClientSession] = None,
+    session: Optional["aiohttp.ClientSession"] = None,
 ) -> List[Dict[str, Any]]:
+    import aiohttp
 
     if not session:
         async with aiohttp.ClientSession() as session:
@@ -1,11 +1,38 @@
-import inspect
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, TypeVar
 
-def ensure_coroutine(listener):
-    if inspect.iscoroutinefunction(listener):
-        return listener
-    else:
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
 
-        async def async_listener(*args):
-            listener(*args)
 
-        return async_listener
\ No newline at end of file
+class LRUCache(Generic[K, V]):
+    """A mapping that evicts its least recently used entries beyond
+max_entries"""
+
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[K, V]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    def __delitem__(self, key: K) -> None:
+        del self._entries[key]
+
+    def get(self, key: K) -> Optional[V]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()